@@ -0,0 +1,168 @@
+"""Per-callback cost of build_keyboard, memoized vs. the original builder.
+
+Run from the repository root::
+
+    python benchmarks/bench_keyboard.py [categories] [callbacks]
+"""
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup  # noqa: E402
+
+
+def legacy_build_keyboard(app: bot.BotApp, session: bot.Session) -> InlineKeyboardMarkup:
+    if session.filter:
+        flt = session.filter.lower()
+        if session.prefix_filter:
+            items = [a for a in app.app_list if a.lower().startswith(flt)]
+        else:
+            items = [a for a in app.app_list if flt in a.lower()]
+    else:
+        items = app.app_list
+    start = session.page * bot.PAGE_SIZE
+    rows = [
+        [InlineKeyboardButton(
+            ("✅" if a in session.apps else "⬜️") + " " + a,
+            callback_data="TOGGLE_" + a,
+        )]
+        for a in items[start:start + bot.PAGE_SIZE]
+    ]
+    nav = []
+    if session.page > 0:
+        nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data="PREV"))
+    if start + bot.PAGE_SIZE < len(items):
+        nav.append(InlineKeyboardButton("下一页 ➡️", callback_data="NEXT"))
+    if nav:
+        rows.append(nav)
+    group_names = list(app.groups.keys())
+    if group_names:
+        gstart = session.group_page * bot.GROUP_PAGE_SIZE
+        rows.append([
+            InlineKeyboardButton(f"📂 {g}", callback_data="TOGGLE_GROUP_" + g)
+            for g in group_names[gstart:gstart + bot.GROUP_PAGE_SIZE]
+        ])
+        if len(group_names) > bot.GROUP_PAGE_SIZE:
+            gnav = []
+            if session.group_page > 0:
+                gnav.append(InlineKeyboardButton("⬅️ 上一页", callback_data="GPREV"))
+            if gstart + bot.GROUP_PAGE_SIZE < len(group_names):
+                gnav.append(InlineKeyboardButton("下一页 ➡️", callback_data="GNEXT"))
+            if gnav:
+                rows.append(gnav)
+    r = []
+    for i, ch in enumerate(bot.ALPHABET):
+        r.append(InlineKeyboardButton(ch, callback_data="LETTER_" + ch))
+        if (i + 1) % 7 == 0 or i == len(bot.ALPHABET) - 1:
+            rows.append(r)
+            r = []
+    sr = [InlineKeyboardButton("🔍 搜索", callback_data="SEARCH")]
+    if session.filter:
+        sr.append(InlineKeyboardButton("❌ 清除", callback_data="CLEAR_FILTER"))
+    rows.append(sr)
+    rows.append([InlineKeyboardButton("✅ 生成配置", callback_data="GENERATE")])
+    return InlineKeyboardMarkup(rows)
+
+
+def synthetic_categories(n: int, rng: random.Random) -> list:
+    letters = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    names = {rng.choice(letters[:26]) + "".join(rng.choice(letters) for _ in range(rng.randint(3, 14)))
+             for _ in range(n)}
+    return sorted(names)
+
+
+def callback_script(app: bot.BotApp, count: int, rng: random.Random) -> list:
+    """Sessions snapshotted after a plausible mix of taps."""
+    sessions = []
+    s = bot.Session()
+    for _ in range(count):
+        roll = rng.random()
+        if roll < 0.6:
+            items = app.filtered_apps(s)
+            page = items[s.page * bot.PAGE_SIZE:(s.page + 1) * bot.PAGE_SIZE]
+            if page:
+                s.apps ^= {rng.choice(page)}
+        elif roll < 0.8:
+            s.page = max(0, s.page + rng.choice((-1, 1)))
+        elif roll < 0.9:
+            s.filter, s.prefix_filter, s.page = rng.choice(bot.ALPHABET), True, 0
+        else:
+            s.filter, s.prefix_filter, s.page = None, False, 0
+        sessions.append(bot.Session(apps=set(s.apps), page=s.page, filter=s.filter,
+                                    prefix_filter=s.prefix_filter))
+    return sessions
+
+
+def count_buttons(fn, sessions: list) -> float:
+    """Average number of InlineKeyboardButton objects constructed per call."""
+    original = InlineKeyboardButton.__init__
+    built = 0
+
+    def counting_init(self, *args, **kwargs):
+        nonlocal built
+        built += 1
+        original(self, *args, **kwargs)
+
+    InlineKeyboardButton.__init__ = counting_init
+    try:
+        for s in sessions:
+            fn(s)
+    finally:
+        InlineKeyboardButton.__init__ = original
+    return built / len(sessions)
+
+
+def measure(label: str, fn, sessions: list, reset=None) -> float:
+    if reset:
+        reset()
+    t0 = time.perf_counter()
+    for s in sessions:
+        fn(s)
+    per_call = (time.perf_counter() - t0) / len(sessions) * 1e6
+    if reset:
+        reset()
+    buttons = count_buttons(fn, sessions)
+    if reset:
+        reset()
+    tracemalloc.start()
+    for s in sessions:
+        fn(s)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:<10} {per_call:8.1f} µs/callback  {buttons:5.1f} buttons built/callback  "
+          f"peak traced {peak / 1024:8.1f} KiB")
+    return per_call
+
+
+def main() -> None:
+    categories = int(sys.argv[1]) if len(sys.argv) > 1 else 700
+    callbacks = int(sys.argv[2]) if len(sys.argv) > 2 else 5000
+    rng = random.Random(42)
+    bot.BOT_TOKEN = bot.BOT_TOKEN or "0:benchmark"
+    app = bot.BotApp()
+    app.set_app_list(synthetic_categories(categories, rng))
+    app.groups = {f"G{i}": app.app_list[i::50][:5] for i in range(12)}
+    sessions = callback_script(app, callbacks, rng)
+
+    for s in sessions[:200]:
+        assert app.build_keyboard(s).to_dict() == legacy_build_keyboard(app, s).to_dict()
+
+    def reset() -> None:
+        app.button_cache.clear()
+        app.row_cache.clear()
+        app.markup_cache.clear()
+
+    print(f"{len(app.app_list)} categories, {len(sessions)} callbacks")
+    legacy = measure("legacy", lambda s: legacy_build_keyboard(app, s), sessions)
+    cold = measure("memo cold", app.build_keyboard, sessions, reset)
+    warm = measure("memo warm", app.build_keyboard, sessions)
+    print(f"speed-up: cold {legacy / cold:.1f}x, warm {legacy / warm:.1f}x "
+          f"(row cache {len(app.row_cache)}, markup cache {len(app.markup_cache)})")
+
+if __name__ == "__main__":
+    main()
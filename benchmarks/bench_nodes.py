@@ -0,0 +1,88 @@
+"""Memory held by parsed nodes: list of NodeMeta vs. NodeStore.
+
+Run from the repository root::
+
+    python benchmarks/bench_nodes.py [nodes]
+
+Both layouts are filled from the same synthetic subscription lines, and the
+proxies rendered from the store are checked against the NodeMeta ones.
+"""
+import gc
+import os
+import random
+import sys
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from nodes import NodeStore  # noqa: E402
+
+REGIONS = list(bot.REGION_ALIAS)
+
+
+def synthetic_lines(count: int, rng: random.Random) -> list:
+    hosts = [f"edge{i}.example.net" for i in range(max(1, count // 20))]
+    lines = []
+    for i in range(count):
+        line = (
+            f"{rng.choice(REGIONS)}-{i:05d},vless,{rng.choice(hosts)},{rng.randrange(1, 65536)},"
+            f"\"{rng.getrandbits(128):032x}\",transport={rng.choice(['tcp', 'ws', 'grpc'])},"
+            f"over-tls=true,skip-cert-verify=false,flow=xtls-rprx-vision,sni=www.msi.com,udp=true"
+        )
+        if rng.random() < 0.5:
+            line += f",public-key=\"{rng.getrandbits(160):040x}\",short-id={rng.getrandbits(32):08x}"
+        lines.append(line)
+    return lines
+
+
+def legacy_proxy(n: bot.NodeMeta) -> dict:
+    return {
+        "name": n.name,
+        "type": "vless",
+        "server": n.host,
+        "port": n.port,
+        "uuid": n.uuid,
+        "network": n.params.get("transport", "tcp"),
+        "flow": n.params.get("flow"),
+        "tls": n.params.get("over-tls") == "true",
+        "skip-cert-verify": n.params.get("skip-cert-verify", "true") != "false",
+        "sni": n.params.get("sni"),
+        "udp": n.params.get("udp") == "true",
+    }
+
+
+def traced(build) -> tuple:
+    gc.collect()
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    obj = build()
+    elapsed = time.perf_counter() - t0
+    held, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return obj, held, elapsed
+
+
+def main() -> int:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 50_000
+    lines = synthetic_lines(count, random.Random(3))
+
+    nodes, list_bytes, list_time = traced(lambda: [bot.parse_node_line(line) for line in lines])
+    store, store_bytes, store_time = traced(lambda: NodeStore.from_nodes(map(bot.parse_node_line, lines)))
+
+    same = list(store.proxies()) == [legacy_proxy(n) for n in nodes]
+    print(f"{count} nodes")
+    print(f"list[NodeMeta] {list_bytes / 1024 / 1024:8.2f} MiB  {list_bytes / count:6.0f} B/node  parse {list_time:.2f} s")
+    print(f"NodeStore      {store_bytes / 1024 / 1024:8.2f} MiB  {store_bytes / count:6.0f} B/node  parse {store_time:.2f} s")
+    print(f"reduction {list_bytes / store_bytes:.1f}x, proxies {'equal' if same else 'MISMATCH'}")
+
+    for label, data in (("list", nodes), ("store", store)):
+        t0 = time.perf_counter()
+        bot.build_config(data, ["Netflix"])
+        print(f"build_config({label}) {(time.perf_counter() - t0) * 1000:8.1f} ms")
+    return 0 if same else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,93 @@
+"""Update throughput with sequential vs. concurrent update processing.
+
+Run from the repository root::
+
+    python benchmarks/bench_updates.py [users]
+
+A local fake Bot API and Gist server stand in for Telegram and GitHub; the
+fake upload (sendDocument) is slow, like a real one. Every user sends a Gist
+link, toggles a rule, presses GENERATE and then pages the keyboard while
+the config is being generated. Updates are fed to the application the way
+the webhook server does, once with ``concurrent_updates(1)`` (the old
+default) and once with CONCURRENT_UPDATES, and the wall time, throughput
+and the latency until each button press is answered are reported.
+"""
+import asyncio
+import itertools
+import os
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from fake_backend import FakeBackend, callback_update, text_update  # noqa: E402
+from telegram import Update  # noqa: E402
+
+PORT = 8791
+NODES = "\n".join(f"HK-{i:02d}=vless,hk{i}.example.net,443,uuid-{i},over-tls=true" for i in range(50))
+GIST = NODES + "\nUS-{key}=vless,us.example.net,443,uuid-{key},over-tls=true"
+
+
+def user_updates(server: FakeBackend, uid: int, ids) -> list:
+    updates = [text_update(next(ids), uid, server.gist_link(uid))]
+    for data in ("TOGGLE_Netflix", "GENERATE", "NEXT", "PREV", "NEXT"):
+        updates.append(callback_update(next(ids), uid, data))
+    return updates
+
+
+async def run(server: FakeBackend, users: int, concurrency: int) -> dict:
+    bot.CONCURRENT_UPDATES = concurrency
+    app = bot.BotApp()
+    app.set_app_list([f"App{i:03d}" for i in range(300)] + ["Netflix"])
+    await app.app.initialize()
+    ids = itertools.count(1)
+    per_user = [user_updates(server, 1000 + u, ids) for u in range(users)]
+    # interleave users, in the order the updates would arrive
+    updates = [Update.de_json(u, app.app.bot) for step in zip(*per_user) for u in step]
+    server.reset(users)
+    sent = {}
+    t0 = time.perf_counter()
+    await app.app.start()
+    for update in updates:
+        if update.callback_query:
+            sent[update.callback_query.id] = time.perf_counter()
+        await app.app.update_queue.put(update)
+    await server.done.wait()
+    while len(server.answered) < len(sent):
+        await asyncio.sleep(0.01)
+    elapsed = time.perf_counter() - t0
+    await app.app.stop()
+    await app.on_shutdown(app.app)
+    await app.app.shutdown()
+    waits = sorted(server.answered[k] - sent[k] for k in sent)
+    return {
+        "elapsed": elapsed,
+        "throughput": len(updates) / elapsed,
+        "p50": statistics.median(waits),
+        "p99": waits[min(len(waits) - 1, int(len(waits) * 0.99))],
+    }
+
+
+async def main() -> None:
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    server = FakeBackend(PORT, GIST)
+    await server.start()
+    bot.BOT_TOKEN = "0:bench"
+    bot.BOT_API_URL = server.url
+    concurrent = max(2, bot.CONCURRENT_UPDATES)
+    try:
+        print(f"{users} users, 6 updates each, upload latency {server.upload_latency * 1000:.0f} ms")
+        for label, n in (("sequential", 1), (f"concurrent({concurrent})", concurrent)):
+            r = await run(server, users, n)
+            print(
+                f"{label:16s} {r['elapsed']:6.2f} s  {r['throughput']:7.1f} updates/s  "
+                f"answer p50 {r['p50'] * 1000:7.1f} ms  p99 {r['p99'] * 1000:7.1f} ms"
+            )
+    finally:
+        await server.stop()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
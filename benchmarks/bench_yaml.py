@@ -0,0 +1,87 @@
+"""Compare build_yaml emitters on synthetic nodes and check they agree.
+
+Run from the repository root::
+
+    python benchmarks/bench_yaml.py [nodes] [apps]
+
+Every emitter's output is loaded back with ``yaml.safe_load`` and compared
+with the reference ``yaml.safe_dump`` document; the script exits non-zero
+if any of them differ.
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import yaml  # noqa: E402
+
+import bot  # noqa: E402
+import clash_yaml  # noqa: E402
+
+REGIONS = list(bot.REGION_ALIAS) + ["XX", "香港"]
+
+
+def synthetic_nodes(count: int, rng: random.Random) -> list:
+    nodes = []
+    for i in range(count):
+        region = rng.choice(REGIONS)
+        params = {"transport": rng.choice(["tcp", "ws", "grpc"]), "over-tls": rng.choice(["true", "false"]),
+                  "udp": rng.choice(["true", "false"]), "sni": f"www.site{i % 97}.com"}
+        if rng.random() < 0.7:
+            params["flow"] = "xtls-rprx-vision"
+        if rng.random() < 0.2:
+            params["skip-cert-verify"] = "false"
+        nodes.append(bot.NodeMeta(
+            name=f"{region}-{i:05d} {rng.choice(['', '专线', 'IPLC', '#1', 'x: y'])}".strip(),
+            host=f"{rng.randrange(1 << 32):08x}.example.net",
+            port=rng.randrange(1, 65536),
+            uuid=f"{rng.getrandbits(128):032x}",
+            params=params,
+            region=region,
+        ))
+    return nodes
+
+
+def timed(fn, repeat: int = 3) -> tuple:
+    best = float("inf")
+    out = None
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        out = fn()
+        best = min(best, time.perf_counter() - t0)
+    return best, out
+
+
+def main() -> int:
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10_000
+    apps = int(sys.argv[2]) if len(sys.argv) > 2 else 40
+    rng = random.Random(7)
+    nodes = synthetic_nodes(count, rng)
+    config = bot.build_config(nodes, [f"App{i}" for i in range(apps)])
+
+    emitters = {"safe_dump": lambda: yaml.safe_dump(config, sort_keys=False, allow_unicode=True)}
+    if clash_yaml._CSafeDumper is not None:
+        emitters["CSafeDumper"] = lambda: yaml.dump(
+            config, Dumper=clash_yaml._CSafeDumper, sort_keys=False, allow_unicode=True)
+    emitters["streaming"] = lambda: clash_yaml.emit_clash_yaml(config)
+
+    print(f"{count} nodes, {apps} apps")
+    reference = None
+    baseline = None
+    failed = False
+    for label, fn in emitters.items():
+        elapsed, text = timed(fn)
+        loaded = yaml.load(text, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+        if reference is None:
+            reference, baseline = loaded, elapsed
+        same = loaded == reference == config
+        failed |= not same
+        print(f"{label:<12} {elapsed * 1000:8.1f} ms  {len(text.encode()) / 1024:8.1f} KiB  "
+              f"{baseline / elapsed:5.1f}x  {'equal' if same else 'MISMATCH'}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
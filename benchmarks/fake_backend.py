@@ -0,0 +1,115 @@
+"""Local stand-ins for the Telegram Bot API and Gist hosting, for load tests.
+
+``FakeBackend`` answers every Bot API method the bot uses with a plausible
+result after a configurable delay, serves synthetic Gists under
+``/raw.githubusercontent.com/<id>/raw`` (which the bot accepts as a Gist
+link), and records when each callback query was answered and each
+document was uploaded.
+"""
+import asyncio
+import itertools
+import time
+
+from aiohttp import web
+
+
+class FakeBackend:
+    def __init__(self, port: int, gist_body: str, api_latency: float = 0.01,
+                 upload_latency: float = 0.3, gist_latency: float = 0.1):
+        self.port = port
+        self.gist_body = gist_body
+        self.api_latency = api_latency
+        self.upload_latency = upload_latency
+        self.gist_latency = gist_latency
+        self.answered = {}
+        self.uploads = []
+        self.expected_uploads = 0
+        self.done = asyncio.Event()
+        self._ids = itertools.count(1)
+        self._waiters = {}
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"http://127.0.0.1:{self.port}"
+
+    def gist_link(self, key) -> str:
+        return f"{self.url}/raw.githubusercontent.com/{key}/raw"
+
+    def wait(self, kind: str, key) -> asyncio.Future:
+        """Resolves when callback query ``key`` is answered (``"answer"``), or
+        when Bot API method ``kind`` (e.g. ``"sendDocument"``) is called for
+        chat ``key``."""
+        fut = asyncio.get_running_loop().create_future()
+        self._waiters[(kind, key)] = fut
+        return fut
+
+    def _wake(self, kind: str, key) -> None:
+        fut = self._waiters.pop((kind, key), None)
+        if fut is not None and not fut.done():
+            fut.set_result(time.perf_counter())
+
+    def reset(self, expected_uploads: int) -> None:
+        self.answered.clear()
+        self.uploads.clear()
+        self.expected_uploads = expected_uploads
+        self.done.clear()
+
+    async def api(self, request: web.Request) -> web.Response:
+        method = request.match_info["method"]
+        data = await request.post()
+        if method == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "bench", "username": "bench_bot"}
+            return web.json_response({"ok": True, "result": result})
+        if method == "answerCallbackQuery":
+            self.answered.setdefault(data["callback_query_id"], time.perf_counter())
+            self._wake("answer", data["callback_query_id"])
+            await asyncio.sleep(self.api_latency)
+            return web.json_response({"ok": True, "result": True})
+        await asyncio.sleep(self.upload_latency if method == "sendDocument" else self.api_latency)
+        result = {
+            "message_id": next(self._ids),
+            "date": int(time.time()),
+            "chat": {"id": int(data.get("chat_id", 0)), "type": "private"},
+        }
+        if method == "sendDocument":
+            result["document"] = {"file_id": f"f{result['message_id']}", "file_unique_id": "u"}
+            self.uploads.append(time.perf_counter())
+            if len(self.uploads) >= self.expected_uploads:
+                self.done.set()
+        self._wake(method, result["chat"]["id"])
+        return web.json_response({"ok": True, "result": result})
+
+    async def gist(self, request: web.Request) -> web.Response:
+        await asyncio.sleep(self.gist_latency)
+        # a distinct body per link, so each user's config is really generated
+        return web.Response(text=self.gist_body.replace("{key}", request.match_info["key"]))
+
+    async def start(self) -> None:
+        app = web.Application()
+        app.router.add_post("/bot{token}/{method}", self.api)
+        app.router.add_get("/raw.githubusercontent.com/{key}/raw", self.gist)
+        self._runner = web.AppRunner(app, access_log=None)
+        await self._runner.setup()
+        await web.TCPSite(self._runner, "127.0.0.1", self.port).start()
+
+    async def stop(self) -> None:
+        if self._runner is not None:
+            await self._runner.cleanup()
+
+
+def text_update(update_id: int, uid: int, text: str) -> dict:
+    user = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "from": user}
+    return {"update_id": update_id, "message": {**message, "text": text}}
+
+
+def callback_update(update_id: int, uid: int, data: str) -> dict:
+    user = {"id": uid, "is_bot": False, "first_name": f"u{uid}"}
+    message = {"message_id": 1, "date": 0, "chat": {"id": uid, "type": "private"}, "text": "keyboard"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id), "from": user, "chat_instance": "x", "message": message, "data": data,
+        },
+    }
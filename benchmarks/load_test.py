@@ -0,0 +1,133 @@
+"""End-to-end load generator against a fake Bot API and Gist server.
+
+Run from the repository root::
+
+    python benchmarks/load_test.py [--users 50] [--rounds 3] [--taps 8] [--nodes 500]
+
+Each simulated user behaves like a person at the keyboard: send a Gist link,
+wait for the keyboard, then tap (toggle a visible rule, page, filter by
+letter) waiting for every answer, press GENERATE and wait for the upload,
+and start over. Updates go through ``Application.update_queue`` exactly as
+the webhook server delivers them. Reported are the p50/p99 latency from a
+tap to its ``answerCallbackQuery``, the tap-to-upload GENERATE latency and
+the GENERATE throughput.
+"""
+import argparse
+import asyncio
+import itertools
+import os
+import random
+import statistics
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from bench_keyboard import synthetic_categories  # noqa: E402
+from bench_nodes import synthetic_lines  # noqa: E402
+from fake_backend import FakeBackend, callback_update, text_update  # noqa: E402
+from telegram import Update  # noqa: E402
+
+
+def percentile(values: list, q: float) -> float:
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+class LoadTest:
+    def __init__(self, app: bot.BotApp, server: FakeBackend, args: argparse.Namespace):
+        self.app = app
+        self.server = server
+        self.args = args
+        self.ids = itertools.count(1)
+        self.tap_latency = []
+        self.generate_latency = []
+        self.generated = 0
+
+    async def send(self, data: dict) -> None:
+        await self.app.app.update_queue.put(Update.de_json(data, self.app.app.bot))
+
+    async def tap(self, uid: int, data: str) -> None:
+        update = callback_update(next(self.ids), uid, data)
+        answered = self.server.wait("answer", update["callback_query"]["id"])
+        t0 = time.perf_counter()
+        await self.send(update)
+        self.tap_latency.append(await answered - t0)
+
+    async def user(self, uid: int, rng: random.Random) -> None:
+        for _ in range(self.args.rounds):
+            shown = self.server.wait("sendMessage", uid)
+            await self.send(text_update(next(self.ids), uid, self.server.gist_link(f"{uid}-{rng.random()}")))
+            await shown
+            for _ in range(self.args.taps):
+                roll = rng.random()
+                if roll < 0.6:
+                    session = self.app.sessions.get(uid) or bot.Session()
+                    items = self.app.filtered_apps(session)
+                    page = items[session.page * bot.PAGE_SIZE:(session.page + 1) * bot.PAGE_SIZE]
+                    await self.tap(uid, "TOGGLE_" + rng.choice(page or ["Netflix"]))
+                elif roll < 0.85:
+                    await self.tap(uid, rng.choice(("NEXT", "PREV")))
+                elif roll < 0.95:
+                    await self.tap(uid, "LETTER_" + rng.choice(bot.ALPHABET))
+                else:
+                    await self.tap(uid, "CLEAR_FILTER")
+                await asyncio.sleep(rng.uniform(0, self.args.think))
+            await self.tap(uid, "TOGGLE_Netflix")
+            uploaded = self.server.wait("sendDocument", uid)
+            t0 = time.perf_counter()
+            await self.tap(uid, "GENERATE")
+            self.generate_latency.append(await uploaded - t0)
+            self.generated += 1
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--taps", type=int, default=8, help="taps per round before GENERATE")
+    parser.add_argument("--nodes", type=int, default=500, help="nodes per Gist")
+    parser.add_argument("--categories", type=int, default=700)
+    parser.add_argument("--think", type=float, default=0.05, help="max pause between taps, seconds")
+    parser.add_argument("--upload-latency", type=float, default=0.3)
+    parser.add_argument("--concurrency", type=int, default=bot.CONCURRENT_UPDATES)
+    parser.add_argument("--port", type=int, default=8792)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    lines = synthetic_lines(args.nodes, random.Random(args.seed))
+    # one node varies with the link, so every GENERATE renders a new config
+    gist = "\n".join(lines) + "\nUS-{key}=vless,us.example.net,443,uuid-{key},over-tls=true"
+    server = FakeBackend(args.port, gist, upload_latency=args.upload_latency)
+    await server.start()
+    bot.BOT_TOKEN = "0:load"
+    bot.BOT_API_URL = server.url
+    bot.CONCURRENT_UPDATES = args.concurrency
+    bot.GENERATE_RATE = 0  # simulated users generate faster than a person would
+    app = bot.BotApp()
+    app.set_app_list(synthetic_categories(args.categories, random.Random(args.seed)) + ["Netflix"])
+    await app.app.initialize()
+    await app.app.start()
+    test = LoadTest(app, server, args)
+    print(f"{args.users} users x {args.rounds} rounds, {args.nodes} nodes, "
+          f"{len(app.app_list)} categories, concurrency {args.concurrency}")
+    t0 = time.perf_counter()
+    try:
+        await asyncio.gather(*(test.user(1000 + u, random.Random(args.seed + u)) for u in range(args.users)))
+    finally:
+        elapsed = time.perf_counter() - t0
+        await app.app.stop()
+        await app.on_shutdown(app.app)
+        await app.app.shutdown()
+        await server.stop()
+    taps = test.tap_latency
+    gens = test.generate_latency
+    print(f"elapsed {elapsed:.2f} s, {len(taps)} taps, {test.generated} configs")
+    print(f"tap -> answer    p50 {statistics.median(taps) * 1000:8.1f} ms  p99 {percentile(taps, 0.99) * 1000:8.1f} ms")
+    print(f"GENERATE -> file p50 {statistics.median(gens) * 1000:8.1f} ms  p99 {percentile(gens, 0.99) * 1000:8.1f} ms")
+    print(f"throughput {test.generated / elapsed:.2f} configs/s, {len(taps) / elapsed:.1f} taps/s")
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
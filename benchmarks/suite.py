@@ -0,0 +1,125 @@
+"""Scaling sweep over the bot's CPU hot paths, with a regression guard.
+
+Run from the repository root::
+
+    python benchmarks/suite.py [--quick] [--save results.json] [--compare baseline.json]
+
+Cases, on seeded synthetic inputs so runs are comparable:
+
+* ``parse_node_line`` at 10 to 50k nodes (per node)
+* ``build_yaml`` at 10 to 50k nodes with 40 rule sets (per config)
+* ``build_keyboard`` / ``build_edit_keyboard`` at 100 to 2k categories, with
+  cold caches and warm (per callback)
+
+Each figure is the best of several repeats. ``--compare`` exits non-zero if
+any case got slower than the baseline by more than ``--tolerance``.
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import bot  # noqa: E402
+from bench_keyboard import callback_script, synthetic_categories  # noqa: E402
+from bench_nodes import synthetic_lines  # noqa: E402
+
+NODE_SCALES = (10, 100, 1000, 10_000, 50_000)
+CATEGORY_SCALES = (100, 500, 1000, 2000)
+CALLBACKS = 2000
+
+
+def best_of(fn, repeat: int) -> float:
+    best = float("inf")
+    for _ in range(repeat):
+        t0 = time.perf_counter()
+        fn()
+        best = min(best, time.perf_counter() - t0)
+    return best
+
+
+def repeats(size: int, quick: bool) -> int:
+    return 1 if quick or size >= 10_000 else 5
+
+
+def bench_parse(results: dict, quick: bool) -> None:
+    for n in NODE_SCALES:
+        lines = synthetic_lines(n, random.Random(n))
+        t = best_of(lambda: [bot.parse_node_line(line) for line in lines], repeats(n, quick))
+        results[f"parse_node_line/{n}"] = t / n
+
+
+def bench_yaml(results: dict, quick: bool) -> None:
+    apps = [f"App{i:02d}" for i in range(40)]
+    for n in NODE_SCALES:
+        store = bot.parse_nodes("\n".join(synthetic_lines(n, random.Random(n))))
+        results[f"build_yaml/{n}"] = best_of(lambda: bot.build_yaml(store, apps), repeats(n, quick))
+
+
+def bench_keyboards(results: dict, quick: bool) -> None:
+    for c in CATEGORY_SCALES:
+        app = bot.BotApp()
+        app.set_app_list(synthetic_categories(c, random.Random(c)))
+        app.groups = {f"G{i}": app.app_list[i::50][:5] for i in range(12)}
+        sessions = callback_script(app, CALLBACKS // 4 if quick else CALLBACKS, random.Random(c))
+        edits = [bot.EditSession("G0", s.apps, s.page, s.filter) for s in sessions]
+        for label, build, inputs in (
+            ("build_keyboard", app.build_keyboard, sessions),
+            ("build_edit_keyboard", app.build_edit_keyboard, edits),
+        ):
+            def run():
+                for s in inputs:
+                    build(s)
+
+            app.set_app_list(app.app_list, app.index)  # clears the keyboard caches
+            results[f"{label}/cold/{c}"] = best_of(run, 1) / len(inputs)
+            results[f"{label}/warm/{c}"] = best_of(run, 1 if quick else 3) / len(inputs)
+
+
+def report(results: dict, baseline: dict | None, tolerance: float) -> int:
+    regressions = 0
+    for case, value in results.items():
+        unit, scale = ("ms", 1e3) if value >= 1e-3 else ("µs", 1e6)
+        line = f"{case:<32} {value * scale:10.2f} {unit}"
+        if baseline and case in baseline:
+            ratio = value / baseline[case]
+            line += f"  {ratio:5.2f}x baseline"
+            if ratio > 1 + tolerance:
+                line += "  REGRESSION"
+                regressions += 1
+        print(line)
+    return regressions
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.split("\n")[0])
+    parser.add_argument("--quick", action="store_true", help="single repeats, fewer callbacks")
+    parser.add_argument("--save", help="write the results as JSON")
+    parser.add_argument("--compare", help="baseline JSON written by --save")
+    parser.add_argument("--tolerance", type=float, default=0.25, help="allowed slowdown, 0.25 = 25%%")
+    args = parser.parse_args()
+
+    bot.BOT_TOKEN = bot.BOT_TOKEN or "0:benchmark"
+    results = {}
+    bench_parse(results, args.quick)
+    bench_yaml(results, args.quick)
+    bench_keyboards(results, args.quick)
+
+    baseline = None
+    if args.compare:
+        with open(args.compare, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+    regressions = report(results, baseline, args.tolerance)
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(results, f, indent=2)
+    if regressions:
+        print(f"{regressions} case(s) slower than baseline by more than {args.tolerance:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
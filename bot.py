@@ -1,12 +1,20 @@
+import os
+import sys
 import json
-import yaml
+import time
+import gzip
+import codecs
+import hashlib
 import asyncio
-import aiohttp
+from contextlib import asynccontextmanager
+from aiohttp import web
 from dotenv import dotenv_values
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import Dict, List, Set
+from typing import Any, Dict, Iterable, Iterator, List, Sequence, Set, Tuple
 
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update, InputFile
+from telegram.error import BadRequest, TelegramError
 from telegram.ext import (
     ApplicationBuilder,
     CommandHandler,
@@ -16,13 +24,121 @@ from telegram.ext import (
     filters,
 )
 
+from http_client import HttpClient
+from search import CategoryIndex
+from edits import EditCoalescer
+from clash_yaml import dump_config
+from config_cache import CachedConfig, ConfigCache, config_key
+from nodes import NodeMeta, NodeStore, merge_stores
+from probe import Prober, rank_nodes
+from rulesets import RuleSetStore, bundle_rules
+from domain_index import DomainIndex, normalize_domain
+from store import open_store, pack, unpack
+from util import LRUCache, atomic_write
+from limits import RateLimiter, SingleFlight
+from subscriptions import ServedConfig, SubscriptionBook, accepts_gzip, not_modified
+from metrics import COUNT_BUCKETS, REGISTRY, SIZE_BUCKETS, TELEGRAM_SECONDS
+
 config = dotenv_values(".env")
 BOT_TOKEN = config.get("BOT_TOKEN")
+BOT_API_URL = config.get("BOT_API_URL") or None
 GITHUB_TOKEN = config.get("GITHUB_TOKEN")
 SESSION_TTL = int(config.get("SESSION_TTL", "3600"))
+SESSION_SWEEP_INTERVAL = min(60, SESSION_TTL)
+SESSION_STORE = config.get("SESSION_STORE", "memory")
+GROUPS_FLUSH_DELAY = float(config.get("GROUPS_FLUSH_DELAY", "2"))
+GROUPS_POLL_INTERVAL = float(config.get("GROUPS_POLL_INTERVAL", "5"))
+EDIT_DEBOUNCE = float(config.get("EDIT_DEBOUNCE", "0.3"))
+GENERATE_EXECUTOR = config.get("GENERATE_EXECUTOR", "thread")
+GENERATE_WORKERS = int(config.get("GENERATE_WORKERS", "2"))
+GENERATE_INLINE_BYTES = int(config.get("GENERATE_INLINE_BYTES", "32768"))
+MAX_CONCURRENT_GENERATIONS = int(config.get("MAX_CONCURRENT_GENERATIONS", "4"))
+GENERATE_RATE = float(config.get("GENERATE_RATE", "6"))
+GENERATE_BURST = int(config.get("GENERATE_BURST", "3"))
+YAML_EMITTER = config.get("YAML_EMITTER", "libyaml")
+CONFIG_CACHE_SIZE = int(config.get("CONFIG_CACHE_SIZE", "64"))
+CONFIG_CACHE_DIR = config.get("CONFIG_CACHE_DIR") or None
+CONFIG_CACHE_DISK_MB = int(config.get("CONFIG_CACHE_DISK_MB", "64"))
+GROUP_TOPOLOGY = config.get("GROUP_TOPOLOGY", "flat")
+REGION_GROUP_TYPE = config.get("REGION_GROUP_TYPE", "url-test")
+GROUP_INTERVAL = int(config.get("GROUP_INTERVAL", "300"))
+GROUP_TOLERANCE = int(config.get("GROUP_TOLERANCE", "50"))
+GROUP_LAZY = config.get("GROUP_LAZY", "true").lower() == "true"
+# Bump whenever build_config output changes so cached configs are not reused.
+GENERATOR_VERSION = "1"
+CACHE_TTL = int(config.get("CACHE_TTL", "600"))
+GIST_MAX_BYTES = int(config.get("GIST_MAX_BYTES", str(8 << 20)))
+GIST_CHUNK_SIZE = 64 << 10
+GIST_CACHE_SIZE = 32
+GIST_FETCH_CONCURRENCY = int(config.get("GIST_FETCH_CONCURRENCY", "4"))
+MAX_SOURCES = 10
+PROBE_MODE = config.get("PROBE_MODE", "off")
+PROBE_TIMEOUT = float(config.get("PROBE_TIMEOUT", "3"))
+PROBE_DEADLINE = float(config.get("PROBE_DEADLINE", "10"))
+PROBE_CONCURRENCY = int(config.get("PROBE_CONCURRENCY", "100"))
+PROBE_TTL = int(config.get("PROBE_TTL", "600"))
+CATALOG_PATH = config.get("CATALOG_PATH", "categories.json")
+CATALOG_REFRESH = int(config.get("CATALOG_REFRESH", "21600"))
+RULE_PROVIDERS = config.get("RULE_PROVIDERS", "http")
+RULESET_DIR = config.get("RULESET_DIR", "rulesets")
+RULESET_CONCURRENCY = int(config.get("RULESET_CONCURRENCY", "8"))
+RULESET_TTL = int(config.get("RULESET_TTL", "86400"))
+RULE_INDEX_PATH = config.get("RULE_INDEX_PATH", "rule_index.json")
+RULE_INDEX_PRELOAD = config.get("RULE_INDEX_PRELOAD", "false").lower() == "true"
+MAX_LOOKUP_RESULTS = 20
+MAX_LISTED_RULE_SETS = 10
+# Telegram limits
+CAPTION_LIMIT = 1024
+MESSAGE_LIMIT = 4096
+CONCURRENT_UPDATES = int(config.get("CONCURRENT_UPDATES", "64"))
+WEBHOOK_URL = config.get("WEBHOOK_URL") or None
+WEBHOOK_LISTEN = config.get("WEBHOOK_LISTEN", "0.0.0.0")
+WEBHOOK_PORT = int(config.get("WEBHOOK_PORT", "8443"))
+WEBHOOK_PATH = config.get("WEBHOOK_PATH", "telegram")
+WEBHOOK_SECRET = config.get("WEBHOOK_SECRET") or None
+ADMIN_IDS = {int(x) for x in config.get("ADMIN_IDS", "").replace(",", " ").split() if x.isdigit()}
+METRICS_LISTEN = config.get("METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(config.get("METRICS_PORT", "0"))
+SUBSCRIPTION_LISTEN = config.get("SUBSCRIPTION_LISTEN", "0.0.0.0")
+SUBSCRIPTION_PORT = int(config.get("SUBSCRIPTION_PORT", "0"))
+SUBSCRIPTION_URL = config.get("SUBSCRIPTION_URL") or None
+SUBSCRIPTIONS_PATH = config.get("SUBSCRIPTIONS_PATH", "subscriptions.json")
+SERVED_CACHE_SIZE = 1024
 PAGE_SIZE = 10
 GROUP_PAGE_SIZE = 5
 ALPHABET = list("ABCDEFGHIJKLMNOPQRSTUVWXYZ")
+ROW_CACHE_SIZE = 2048
+
+GIST_FETCH_SECONDS = REGISTRY.histogram(
+    "clashbot_gist_fetch_seconds", "Gist download and parse time", labels=("result",)
+)
+GIST_BYTES = REGISTRY.histogram("clashbot_gist_bytes", "Downloaded Gist size", SIZE_BUCKETS)
+PARSE_SECONDS = REGISTRY.histogram("clashbot_parse_seconds", "Node line parsing time per Gist")
+PARSED_LINES = REGISTRY.counter("clashbot_parsed_lines_total", "Gist lines parsed", ("result",))
+CATALOG_FETCH_SECONDS = REGISTRY.histogram(
+    "clashbot_catalog_fetch_seconds", "Rule category list fetch time", labels=("result",)
+)
+RENDER_SECONDS = REGISTRY.histogram("clashbot_render_seconds", "Config rendering time (build_yaml)")
+CONFIG_BYTES = REGISTRY.histogram("clashbot_config_bytes", "Generated config size", SIZE_BUCKETS)
+CONFIG_NODES = REGISTRY.histogram("clashbot_config_nodes", "Nodes per generated config", COUNT_BUCKETS)
+CONFIG_CACHE_LOOKUPS = REGISTRY.counter("clashbot_config_cache_total", "Config cache lookups", ("result",))
+GENERATE_SECONDS = REGISTRY.histogram("clashbot_generate_seconds", "GENERATE from tap to upload")
+GENERATE_REJECTED = REGISTRY.counter(
+    "clashbot_generate_rejected_total", "GENERATE taps turned away", ("reason",)
+)
+COALESCED = REGISTRY.counter(
+    "clashbot_coalesced_total", "Requests that joined an identical one in flight", ("kind",)
+)
+SUBSCRIPTION_REQUESTS = REGISTRY.counter(
+    "clashbot_subscription_requests_total", "Subscription URL requests", ("result",)
+)
+KEYBOARD_SECONDS = REGISTRY.histogram(
+    "clashbot_keyboard_seconds", "Inline keyboard build time", labels=("keyboard",)
+)
+ACTION_SECONDS = REGISTRY.histogram(
+    "clashbot_action_seconds", "Button handling time, excluding generation", labels=("action",)
+)
+ACTION_PREFIXES = ("TOGGLE_GROUP_", "TOGGLE_", "EG_TOGGLE_", "LETTER_")
 
 alias = {
     "PrimeVideo": "AmazonPrimeVideo",
@@ -32,37 +148,35 @@ alias = {
     "X": "Twitter",
 }
 
-@dataclass
-class NodeMeta:
-    name: str
-    host: str
-    port: int
-    uuid: str
-    params: Dict[str, str]
-    region: str
-
-
-async def fetch_gist_raw(url: str, token: str | None = None) -> str:
-    raw_url = url if "/raw" in url else url.replace("gist.github.com", "gist.githubusercontent.com") + "/raw"
-    headers = {"Authorization": f"token {token}"} if token else None
-    async with aiohttp.ClientSession() as session:
-        async with session.get(raw_url, headers=headers, timeout=15) as resp:
-            resp.raise_for_status()
-            return await resp.text()
+def gist_raw_url(url: str) -> str:
+    return url if "/raw" in url else url.replace("gist.github.com", "gist.githubusercontent.com") + "/raw"
 
 
 def parse_node_line(line: str) -> NodeMeta:
-    name, _type, host, port_str, uuid, *rest = line.split(",")
+    head, *fields = line.split(",")
+    if "=" in head:
+        # "HK-01=vless,host,port,..." as documented in the README
+        name, _type = head.split("=", 1)
+    elif fields:
+        name, _type = head, fields.pop(0)
+    else:
+        raise ValueError("不是节点定义")
+    if len(fields) < 3:
+        raise ValueError("字段不足，需要 名称,类型,地址,端口,UUID")
+    host, port_str, uuid, *rest = fields
     params: Dict[str, str] = {}
     for p in rest:
         if "=" in p:
             k, v = p.split("=", 1)
             params[k.strip()] = v.replace('"', '').strip()
+    port = int(port_str)
+    if not 1 <= port <= 65535:
+        raise ValueError(f"端口超出范围: {port}")
     region = name.split("-")[0]
     return NodeMeta(
         name=name.strip(),
         host=host.strip(),
-        port=int(port_str),
+        port=port,
         uuid=uuid.replace('"', '').strip(),
         params=params,
         region=region,
@@ -87,43 +201,84 @@ REGION_ALIAS = {
 }
 
 
-def build_yaml(nodes: List[NodeMeta], apps: List[str]) -> str:
-    proxies = [
-        {
-            "name": n.name,
-            "type": "vless",
-            "server": n.host,
-            "port": n.port,
-            "uuid": n.uuid,
-            "network": n.params.get("transport", "tcp"),
-            "flow": n.params.get("flow"),
-            "tls": n.params.get("over-tls") == "true",
-            "skip-cert-verify": n.params.get("skip-cert-verify", "true") != "false",
-            "sni": n.params.get("sni"),
-            "udp": n.params.get("udp") == "true",
-        }
-        for n in nodes
-    ]
+@dataclass(frozen=True)
+class GroupLayout:
+    """How proxy groups are laid out.
+
+    ``flat`` puts every proxy into one url-test group and uses plain select
+    groups per region. ``regional`` makes each region a health-checked group
+    of ``region_type`` and has Automatic test only the region groups, so a
+    client probes one proxy per region rather than every node.
+    """
+
+    topology: str = "flat"
+    region_type: str = "url-test"
+    interval: int = 300
+    tolerance: int = 50
+    lazy: bool = True
+
+
+GROUP_LAYOUT = GroupLayout(GROUP_TOPOLOGY, REGION_GROUP_TYPE, GROUP_INTERVAL, GROUP_TOLERANCE, GROUP_LAZY)
+TEST_URL = "https://cp.cloudflare.com/generate_204"
+
+
+def rule_set_url(folder: str) -> str:
+    return f"{BASE_URL}/{folder}/{folder}.yaml"
+
+
+def health_checked_group(name: str, kind: str, proxies: List[str], layout: GroupLayout) -> Dict[str, Any]:
+    group: Dict[str, Any] = {"name": name, "type": kind, "url": TEST_URL, "interval": layout.interval}
+    if kind == "url-test":
+        group["tolerance"] = layout.tolerance
+    elif kind == "load-balance":
+        group["strategy"] = "consistent-hashing"
+    group["lazy"] = layout.lazy
+    group["proxies"] = proxies
+    return group
+
+
+def build_config(
+    nodes: NodeStore | Iterable[NodeMeta],
+    apps: List[str],
+    layout: GroupLayout = GroupLayout(),
+    rule_sets: Dict[str, List[str]] | None = None,
+) -> Dict[str, Any]:
+    """Clash config dict. Apps found in ``rule_sets`` get an inline provider
+    with their (de-duplicated) rules; the rest point at ``BASE_URL``."""
+    if not isinstance(nodes, NodeStore):
+        nodes = NodeStore.from_nodes(nodes)
+    proxies = list(nodes.proxies())
 
     region_proxy_map: Dict[str, List[str]] = {}
-    for n in nodes:
-        name = REGION_ALIAS.get(n.region, n.region)
-        region_proxy_map.setdefault(name, []).append(n.name)
+    for name, region in zip(nodes.names, nodes.regions):
+        region_proxy_map.setdefault(REGION_ALIAS.get(region, region), []).append(name)
     region_names = list(region_proxy_map.keys())
 
     auto_group = "Automatic"
+    if layout.topology == "regional":
+        top_groups = [
+            health_checked_group(auto_group, "url-test", region_names, layout),
+            *[
+                health_checked_group(r, layout.region_type, region_proxy_map[r], layout)
+                for r in region_names
+            ],
+        ]
+    else:
+        top_groups = [
+            {
+                "name": auto_group,
+                "type": "url-test",
+                "url": TEST_URL,
+                "interval": layout.interval,
+                "proxies": [p["name"] for p in proxies],
+            },
+            *[
+                {"name": r, "type": "select", "proxies": region_proxy_map[r]}
+                for r in region_names
+            ],
+        ]
     groups = [
-        {
-            "name": auto_group,
-            "type": "url-test",
-            "url": "https://cp.cloudflare.com/generate_204",
-            "interval": 300,
-            "proxies": [p["name"] for p in proxies],
-        },
-        *[
-            {"name": r, "type": "select", "proxies": region_proxy_map[r]}
-            for r in region_names
-        ],
+        *top_groups,
         {"name": "DIRECT", "type": "direct"},
         {"name": "REJECT", "type": "reject"},
         *[
@@ -136,13 +291,18 @@ def build_yaml(nodes: List[NodeMeta], apps: List[str]) -> str:
         ],
     ]
 
+    rule_sets = rule_sets or {}
+    inline = bundle_rules([(app, rule_sets[app]) for app in apps if app in rule_sets])
     rule_providers = {}
     for app in apps:
+        if app in inline:
+            rule_providers[app] = {"type": "inline", "behavior": "classical", "payload": inline[app]}
+            continue
         folder = alias.get(app, app)
         rule_providers[app] = {
             "type": "http",
             "behavior": "domain",
-            "url": f"{BASE_URL}/{folder}/{folder}.yaml",
+            "url": rule_set_url(folder),
             "path": f"./rules/{folder}.yaml",
             "interval": 86400,
         }
@@ -160,64 +320,413 @@ def build_yaml(nodes: List[NodeMeta], apps: List[str]) -> str:
         "rule-providers": rule_providers,
         "rules": rule_lines,
     }
-    return yaml.safe_dump(config, sort_keys=False, allow_unicode=True)
+    return config
 
 
-def load_groups(path: str = "groups.json") -> Dict[str, List[str]]:
-    try:
-        with open(path, "r", encoding="utf-8") as f:
-            obj = json.load(f)
-            result = {k: [str(x) for x in v] for k, v in obj.items() if isinstance(v, list)}
-            return result
-    except Exception:
-        return {}
+def build_yaml(
+    nodes: NodeStore | Iterable[NodeMeta],
+    apps: List[str],
+    layout: GroupLayout = GroupLayout(),
+    rule_sets: Dict[str, List[str]] | None = None,
+) -> str:
+    return dump_config(build_config(nodes, apps, layout, rule_sets), YAML_EMITTER)
+
+
+INFO_NODE_KEYWORDS = ("剩余流量", "距离下次重置剩余", "套餐到期")
+
+
+MAX_REPORTED_ERRORS = 10
+
+
+@dataclass(slots=True)
+class ParseReport:
+    lines: int = 0
+    skipped: int = 0
+    error_count: int = 0
+    errors: List[Tuple[int, str]] = field(default_factory=list)
+
+    def add_error(self, lineno: int, message: str) -> None:
+        self.error_count += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append((lineno, message))
+
+    def summary(self) -> str:
+        lines = [f"有 {self.error_count} 行无法解析，已跳过："]
+        lines += [f"第 {n} 行: {msg}" for n, msg in self.errors]
+        if self.error_count > len(self.errors):
+            lines.append(f"……另有 {self.error_count - len(self.errors)} 行")
+        return "\n".join(lines)
+
+
+def parse_node_stream(lines: Iterable[str], report: ParseReport) -> Iterator[NodeMeta]:
+    """Parse lines lazily, recording bad lines in ``report`` instead of raising."""
+    for line in lines:
+        report.lines += 1
+        line = line.strip()
+        if not line:
+            continue
+        try:
+            node = parse_node_line(line)
+        except Exception as e:
+            report.add_error(report.lines, str(e)[:100])
+            continue
+        if any(k in node.name for k in INFO_NODE_KEYWORDS):
+            report.skipped += 1
+            continue
+        yield node
+
+
+def parse_nodes(raw: str, report: ParseReport | None = None) -> NodeStore:
+    return NodeStore.from_nodes(parse_node_stream(raw.splitlines(), report or ParseReport()))
+
+
+def render_config(
+    nodes: NodeStore,
+    apps: List[str],
+    layout: GroupLayout = GroupLayout(),
+    rule_sets: Dict[str, List[str]] | None = None,
+) -> bytes:
+    return build_yaml(nodes, apps, layout, rule_sets).encode("utf-8")
+
+
+class GistError(Exception):
+    """A Gist could not be fetched or parsed; str() is the message for the user."""
+
+
+@dataclass(slots=True)
+class ParsedGist:
+    digest: str
+    size: int
+    nodes: NodeStore
+    report: ParseReport
+    etag: str | None = None
+    fetched_at: float = field(default_factory=time.monotonic)
+
+
+async def fetch_gist_nodes(
+    client: HttpClient,
+    url: str,
+    token: str | None = None,
+    etag: str | None = None,
+    max_bytes: int = GIST_MAX_BYTES,
+    inline_bytes: int = GENERATE_INLINE_BYTES,
+) -> ParsedGist | None:
+    """Stream a Gist and parse it chunk by chunk; None if unchanged since ``etag``.
+
+    Only the current chunk and the unfinished last line are held in memory,
+    and the body is hashed on the fly for the config cache. Once more than
+    ``inline_bytes`` have arrived, chunks are parsed in a worker thread so
+    a large Gist does not hold up the event loop.
+    """
+    headers = {"Authorization": f"token {token}"} if token else None
+    async with client.stream(gist_raw_url(url), headers=headers, etag=etag) as resp:
+        if resp.status == 304:
+            return None
+        if resp.content_length is not None and resp.content_length > max_bytes:
+            raise GistError(f"Gist 内容超过 {max_bytes / (1 << 20):.1f} MB 上限")
+        report = ParseReport()
+        nodes = NodeStore()
+        digest = hashlib.sha256()
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+
+        def parse(chunk: bytes, final: bool = False) -> float:
+            nonlocal pending
+            t0 = time.perf_counter()
+            lines = (pending + decoder.decode(chunk, final)).split("\n")
+            pending = "" if final else lines.pop()
+            nodes.extend(parse_node_stream(lines, report))
+            return time.perf_counter() - t0
+
+        size = 0
+        parse_time = 0.0
+        async for chunk in resp.content.iter_chunked(GIST_CHUNK_SIZE):
+            size += len(chunk)
+            if size > max_bytes:
+                raise GistError(f"Gist 内容超过 {max_bytes / (1 << 20):.1f} MB 上限")
+            digest.update(chunk)
+            if size > inline_bytes:
+                parse_time += await asyncio.to_thread(parse, chunk)
+            else:
+                parse_time += parse(chunk)
+        parse_time += parse(b"", final=True)
+        PARSE_SECONDS.observe(parse_time)
+        GIST_BYTES.observe(size)
+        PARSED_LINES.inc("node", amount=len(nodes))
+        PARSED_LINES.inc("bad", amount=report.error_count)
+        PARSED_LINES.inc("info", amount=report.skipped)
+        return ParsedGist(digest.hexdigest(), size, nodes, report, resp.headers.get("ETag"))
+
+
+@dataclass(slots=True)
+class SourceStat:
+    url: str
+    elapsed: float
+    nodes: int = 0
+    bad_lines: int = 0
+    error: str | None = None
 
 
-def save_groups(groups: Dict[str, List[str]], path: str = "groups.json") -> None:
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(groups, f, ensure_ascii=False, indent=2)
+@dataclass(slots=True)
+class NodeSet:
+    """Nodes merged from all of a session's sources."""
 
+    digest: str
+    size: int
+    nodes: NodeStore
+    sources: List[SourceStat]
+    duplicates: int = 0
+    fetched_at: float = field(default_factory=time.monotonic)
 
-async def fetch_rule_categories(token: str | None = None) -> List[str]:
+    @property
+    def bad_lines(self) -> int:
+        return sum(s.bad_lines for s in self.sources)
+
+    def caption(self) -> str:
+        lines = ["配置生成成功 🎉"]
+        if len(self.sources) > 1:
+            for n, src in enumerate(self.sources, 1):
+                # the full error goes out as a separate message, see failures()
+                status = "获取失败" if src.error else f"{src.nodes} 个节点"
+                lines.append(f"来源 {n}：{src.elapsed * 1000:.0f} ms，{status}")
+        if self.duplicates:
+            lines.append(f"已去除 {self.duplicates} 个重复节点")
+        if self.bad_lines:
+            lines.append(f"已跳过 {self.bad_lines} 行无效节点")
+        return "\n".join(lines)
+
+    def failures(self) -> str:
+        return "\n\n".join(
+            f"来源 {n}：{src.error}" for n, src in enumerate(self.sources, 1) if src.error
+        )
+
+
+def clip_text(text: str, limit: int) -> str:
+    """Cut ``text`` at a line break so it fits in ``limit`` characters."""
+    if len(text) <= limit:
+        return text
+    return text[: limit - 3].rsplit("\n", 1)[0] + "\n……"
+
+
+def sources_digest(parsed: Iterable[ParsedGist]) -> str:
+    return hashlib.sha256("\n".join(p.digest for p in parsed).encode("ascii")).hexdigest()
+
+
+def merge_sources(results: List[Tuple[SourceStat, ParsedGist | None]]) -> NodeSet:
+    parsed = [p for _, p in results if p is not None]
+    nodes, duplicates = merge_stores(p.nodes for p in parsed)
+    return NodeSet(
+        digest=sources_digest(parsed),
+        size=sum(p.size for p in parsed),
+        nodes=nodes,
+        sources=[stat for stat, _ in results],
+        duplicates=duplicates,
+        fetched_at=min((p.fetched_at for p in parsed), default=time.monotonic()),
+    )
+
+
+def action_label(data: str) -> str:
+    """Metric label for callback data: the prefix for per-item buttons."""
+    for prefix in ACTION_PREFIXES:
+        if data.startswith(prefix):
+            return prefix[:-1]
+    return data
+
+
+def extract_gist_links(text: str) -> List[str]:
+    return [
+        word for word in text.split()
+        if "gist.github" in word or "raw.githubusercontent" in word
+    ]
+
+
+async def fetch_rule_categories(
+    client: HttpClient, token: str | None = None, etag: str | None = None
+) -> Tuple[List[str] | None, str | None]:
+    """Return ``(names, etag)``; names is None if unchanged since ``etag``."""
     url = "https://api.github.com/repos/blackmatrix7/ios_rule_script/contents/rule/Clash?ref=master"
     headers = {"Authorization": f"token {token}"} if token else None
-    async with aiohttp.ClientSession() as session:
-        async with session.get(url, headers=headers, timeout=15) as resp:
-            resp.raise_for_status()
-            data = await resp.json()
-            return sorted([item["name"] for item in data if item.get("type") == "dir"])
+    body, etag = await client.get_if_changed(url, headers=headers, etag=etag)
+    if body is None:
+        return None, etag
+    data = json.loads(body)
+    return sorted([item["name"] for item in data if item.get("type") == "dir"]), etag
+
+
+def load_catalog(path: str = CATALOG_PATH) -> Tuple[List[str], str | None]:
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            obj = json.load(f)
+            return [str(x) for x in obj.get("names", [])], obj.get("etag")
+    except Exception:
+        return [], None
+
 
+def save_catalog(names: List[str], etag: str | None, path: str = CATALOG_PATH) -> None:
+    atomic_write(path, json.dumps({"etag": etag, "names": names}, ensure_ascii=False))
 
-@dataclass
+
+@dataclass(slots=True)
 class Session:
-    gist: str | None = None
+    gists: Tuple[str, ...] = ()
     apps: Set[str] = field(default_factory=set)
-    last_active: float = field(default_factory=lambda: asyncio.get_event_loop().time())
+    last_active: float = field(default_factory=time.monotonic)
     page: int = 0
     filter: str | None = None
     awaiting_search: bool = False
     group_page: int = 0
     prefix_filter: bool = False
+    prefetch: asyncio.Task | None = None
+
+    def to_state(self) -> list:
+        return [list(self.gists), sorted(self.apps), self.page, self.filter,
+                self.awaiting_search, self.group_page, self.prefix_filter]
 
+    @classmethod
+    def from_state(cls, state: list) -> "Session":
+        gists, apps, page, filter, awaiting_search, group_page, prefix_filter = state
+        return cls(tuple(gists), set(apps), time.monotonic(), page, filter,
+                   awaiting_search, group_page, prefix_filter)
 
-@dataclass
+
+@dataclass(slots=True)
 class EditSession:
     group: str
     apps: Set[str]
     page: int = 0
     filter: str | None = None
     awaiting_search: bool = False
+    last_active: float = field(default_factory=time.monotonic)
+
+    def to_state(self) -> list:
+        return [self.group, sorted(self.apps), self.page, self.filter, self.awaiting_search]
+
+    @classmethod
+    def from_state(cls, state: list) -> "EditSession":
+        group, apps, page, filter, awaiting_search = state
+        return cls(group, set(apps), page, filter, awaiting_search)
+
+
+def approx_session_size(s: Session | EditSession) -> int:
+    """Rough byte footprint of a session, not counting interned app names."""
+    size = sys.getsizeof(s) + sys.getsizeof(s.apps)
+    for attr in ("gists", "filter", "group"):
+        value = getattr(s, attr, None)
+        if value is not None:
+            size += sys.getsizeof(value)
+    for url in getattr(s, "gists", ()):
+        size += sys.getsizeof(url)
+    return size
+
+
+@dataclass(frozen=True)
+class KeyboardStyle:
+    toggle: str
+    prev: InlineKeyboardButton
+    next: InlineKeyboardButton
+    search_row: Tuple[InlineKeyboardButton, ...]
+    search_clear_row: Tuple[InlineKeyboardButton, ...]
+    footer: Tuple[Tuple[InlineKeyboardButton, ...], ...]
+
+
+def _keyboard_style(prefix: str, footer: Tuple[Tuple[InlineKeyboardButton, ...], ...]) -> KeyboardStyle:
+    search = InlineKeyboardButton("🔍 搜索", callback_data=prefix + "SEARCH")
+    return KeyboardStyle(
+        toggle=prefix + "TOGGLE_",
+        prev=InlineKeyboardButton("⬅️ 上一页", callback_data=prefix + "PREV"),
+        next=InlineKeyboardButton("下一页 ➡️", callback_data=prefix + "NEXT"),
+        search_row=(search,),
+        search_clear_row=(search, InlineKeyboardButton("❌ 清除", callback_data=prefix + "CLEAR_FILTER")),
+        footer=footer,
+    )
+
+
+# Buttons are immutable, so the parts of the keyboards that never change are
+# built once and shared by every rendered markup.
+MAIN_KEYBOARD = _keyboard_style(
+    "", ((InlineKeyboardButton("✅ 生成配置", callback_data="GENERATE"),),)
+)
+EDIT_KEYBOARD = _keyboard_style(
+    "EG_",
+    ((
+        InlineKeyboardButton("✅ 保存", callback_data="EG_SAVE"),
+        InlineKeyboardButton("取消", callback_data="EG_CANCEL"),
+    ),),
+)
+GROUP_PREV_BUTTON = InlineKeyboardButton("⬅️ 上一页", callback_data="GPREV")
+GROUP_NEXT_BUTTON = InlineKeyboardButton("下一页 ➡️", callback_data="GNEXT")
+LETTER_ROWS = tuple(
+    tuple(InlineKeyboardButton(ch, callback_data="LETTER_" + ch) for ch in ALPHABET[i:i + 7])
+    for i in range(0, len(ALPHABET), 7)
+)
 
 
 class BotApp:
     def __init__(self):
         if not BOT_TOKEN:
             raise RuntimeError("BOT_TOKEN is not set")
-        self.app = ApplicationBuilder().token(BOT_TOKEN).build()
+        builder = (
+            ApplicationBuilder()
+            .token(BOT_TOKEN)
+            .concurrent_updates(CONCURRENT_UPDATES)
+            .post_init(self.on_startup)
+            .post_shutdown(self.on_shutdown)
+        )
+        if BOT_API_URL:
+            api = BOT_API_URL.rstrip("/")
+            builder = builder.base_url(f"{api}/bot").base_file_url(f"{api}/file/bot")
+        self.app = builder.build()
+        self.http = HttpClient()
+        self.sweeper_task: asyncio.Task | None = None
+        self.catalog_task: asyncio.Task | None = None
+        self.groups_task: asyncio.Task | None = None
+        self.catalog_etag: str | None = None
+        self.catalog_stale = False
+        self.edits = EditCoalescer(EDIT_DEBOUNCE)
+        self.executor: Executor | None = None
+        self.generate_slots = asyncio.Semaphore(MAX_CONCURRENT_GENERATIONS)
+        # GENERATE_RATE is per minute
+        self.generate_limiter = RateLimiter(GENERATE_RATE / 60, GENERATE_BURST)
+        self.generating: Set[int] = set()
+        self.fetch_flights = SingleFlight()
+        self.render_flights = SingleFlight()
+        self.gist_cache = LRUCache(GIST_CACHE_SIZE)
+        self.fetch_slots = asyncio.Semaphore(GIST_FETCH_CONCURRENCY)
+        self.prober = Prober(PROBE_CONCURRENCY, PROBE_TIMEOUT, PROBE_DEADLINE, PROBE_TTL)
+        self.configs = ConfigCache(CONFIG_CACHE_SIZE, CONFIG_CACHE_DIR, CONFIG_CACHE_DISK_MB << 20)
+        self.rulesets = RuleSetStore(
+            self.http, rule_set_url, RULESET_DIR, RULESET_CONCURRENCY, RULESET_TTL
+        )
+        self.domain_index = DomainIndex()
+        self.index_task: asyncio.Task | None = None
         self.sessions: Dict[int, Session] = {}
         self.edit_sessions: Dict[int, EditSession] = {}
+        self.store = open_store(SESSION_STORE, flush_delay=GROUPS_FLUSH_DELAY)
+        self.user_locks: Dict[int, asyncio.Lock] = {}
         self.app_list: List[str] = []
+        self.index = CategoryIndex(self.app_list)
+        self.button_cache: Dict[Tuple[str, str, bool], InlineKeyboardButton] = {}
+        self.row_cache = LRUCache(ROW_CACHE_SIZE)
+        self.markup_cache = LRUCache(ROW_CACHE_SIZE)
+        self.group_row_cache: Dict[int, Tuple[Tuple[InlineKeyboardButton, ...], ...]] = {}
         self.groups: Dict[str, List[str]] = {}
+        self.metrics_runner: web.AppRunner | None = None
+        self.subscriptions = SubscriptionBook(SUBSCRIPTIONS_PATH)
+        self.served = LRUCache(SERVED_CACHE_SIZE)
+        self.gzipped = LRUCache(CONFIG_CACHE_SIZE)
+        self.subscription_runner: web.AppRunner | None = None
+        REGISTRY.gauge("clashbot_sessions", "Active selection sessions", lambda: len(self.sessions))
+        REGISTRY.gauge("clashbot_edit_sessions", "Active group edit sessions", lambda: len(self.edit_sessions))
+        REGISTRY.gauge("clashbot_session_bytes", "Approximate session memory",
+                       lambda: self.session_stats()["approx_bytes"])
+        REGISTRY.gauge("clashbot_gist_cache_entries", "Parsed Gists in memory", lambda: len(self.gist_cache))
+        REGISTRY.gauge("clashbot_config_cache_entries", "Generated configs in memory", lambda: len(self.configs))
+        REGISTRY.gauge("clashbot_categories", "Rule categories in the catalog", lambda: len(self.app_list))
+        REGISTRY.gauge("clashbot_indexed_rule_sets", "Rule sets in the domain index", lambda: len(self.domain_index))
+        REGISTRY.gauge("clashbot_subscriptions", "Issued subscription URLs", lambda: len(self.subscriptions))
+        for stat in ("sent", "skipped", "failed", "retry_after"):
+            REGISTRY.gauge(f"clashbot_keyboard_edits_{stat}", f"Keyboard edits {stat.replace('_', ' ')}",
+                           lambda stat=stat: self.edits.stats[stat])
 
         self.app.add_handler(CommandHandler("start", self.start))
         self.app.add_handler(CommandHandler("help", self.help))
@@ -226,115 +735,468 @@ class BotApp:
         self.app.add_handler(CommandHandler("addrules", self.add_rules))
         self.app.add_handler(CommandHandler("removerules", self.remove_rules))
         self.app.add_handler(CommandHandler("editgroup", self.edit_group))
+        self.app.add_handler(CommandHandler("addgist", self.add_gist))
+        self.app.add_handler(CommandHandler("whichrule", self.which_rule))
+        self.app.add_handler(CommandHandler("stats", self.cmd_stats))
+        self.app.add_handler(CommandHandler("subscribe", self.subscribe))
+        self.app.add_handler(CommandHandler("unsubscribe", self.unsubscribe))
         self.app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, self.on_text))
         self.app.add_handler(CallbackQueryHandler(self.on_action))
 
     async def load_initial(self):
+        names, self.catalog_etag = load_catalog()
+        # a snapshot may be old, so revalidate it right away in the background
+        self.catalog_stale = bool(names)
+        if names:
+            self.set_app_list([alias.get(name, name) for name in names])
+        elif not await self.refresh_catalog():
+            self.set_app_list([])
         try:
-            self.app_list = [
-                alias.get(name, name)
-                for name in await fetch_rule_categories(GITHUB_TOKEN)
-            ]
+            self.groups = await self.store.load_groups()
+        except ValueError as e:
+            print(f"Failed to load groups: {e}")
+            self.groups = {}
+        self.invalidate_group_rows()
+
+    async def refresh_catalog(self) -> bool:
+        """Fetch the category list if it changed and swap it in; True on swap."""
+        t0 = time.perf_counter()
+        try:
+            names, etag = await fetch_rule_categories(self.http, GITHUB_TOKEN, self.catalog_etag)
         except Exception as e:
+            CATALOG_FETCH_SECONDS.observe(time.perf_counter() - t0, "error")
             print("Failed to fetch categories", e)
-            self.app_list = []
-        self.groups = load_groups()
+            return False
+        CATALOG_FETCH_SECONDS.observe(time.perf_counter() - t0, "not_modified" if names is None else "ok")
+        if names is None:
+            return False
+        self.catalog_etag = etag
+        try:
+            await asyncio.to_thread(save_catalog, names, etag)
+        except OSError as e:
+            print(f"Failed to save {CATALOG_PATH}: {e}")
+        aliased = [alias.get(name, name) for name in names]
+        if aliased == self.app_list:
+            return False
+        index = await asyncio.to_thread(CategoryIndex, aliased)
+        self.set_app_list(aliased, index)
+        return True
+
+    async def catalog_refresher(self, delay: float) -> None:
+        while True:
+            await asyncio.sleep(delay)
+            delay = CATALOG_REFRESH
+            try:
+                if await self.refresh_catalog():
+                    print(f"📚 规则分类已更新，共 {len(self.app_list)} 个")
+            except Exception as e:
+                print("Failed to refresh categories", e)
+
+    def set_app_list(self, names: List[str], index: CategoryIndex | None = None) -> None:
+        self.index = index or CategoryIndex(names)
+        self.app_list = names
+        self.button_cache.clear()
+        self.row_cache.clear()
+        self.markup_cache.clear()
+
+    def invalidate_group_rows(self) -> None:
+        self.group_row_cache.clear()
+        self.markup_cache.clear()
+
+    async def store_groups(self, *names: str) -> None:
+        """Persist after the named groups were changed or removed."""
+        self.invalidate_group_rows()
+        await self.store.save_groups(self.groups, names)
+
+    async def reload_groups(self) -> None:
+        """Pick up group changes made outside this worker: edits to
+        groups.json, or other workers sharing the store."""
+        try:
+            groups = await self.store.load_groups()
+        except ValueError as e:
+            print(f"Failed to reload groups, keeping the current ones: {e}")
+            return
+        if groups != self.groups:
+            self.groups = groups
+            self.invalidate_group_rows()
+            print(f"🔄 已重新加载 {len(groups)} 个分组")
+
+    async def groups_watcher(self) -> None:
+        while True:
+            await asyncio.sleep(GROUPS_POLL_INTERVAL)
+            try:
+                if await self.store.groups_changed():
+                    await self.reload_groups()
+            except Exception as e:
+                print(f"Failed to check groups: {e}")
+
+    async def on_startup(self, application) -> None:
+        await self.load_initial()
+        self.domain_index = await asyncio.to_thread(DomainIndex.load, RULE_INDEX_PATH)
+        self.rulesets.listeners = [self.domain_index.add]
+        self.catalog_task = asyncio.create_task(
+            self.catalog_refresher(0 if self.catalog_stale else CATALOG_REFRESH)
+        )
+        self.sweeper_task = asyncio.create_task(self.session_sweeper())
+        self.groups_task = asyncio.create_task(self.groups_watcher())
+        if RULE_INDEX_PRELOAD:
+            self.index_task = asyncio.create_task(self.preload_rule_index())
+        if METRICS_PORT:
+            await self.start_metrics_server()
+        if SUBSCRIPTION_PORT:
+            self.subscriptions = await asyncio.to_thread(SubscriptionBook.load, SUBSCRIPTIONS_PATH)
+            await self.start_subscription_server()
+
+    async def on_shutdown(self, application) -> None:
+        for task in (self.sweeper_task, self.catalog_task, self.index_task, self.groups_task):
+            if task:
+                task.cancel()
+        await self.save_rule_index()
+        await self.store.close()
+        for runner in (self.metrics_runner, self.subscription_runner):
+            if runner is not None:
+                await runner.cleanup()
+        await self.edits.close()
+        await self.http.close()
+        if self.executor is not None:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+    async def start_metrics_server(self) -> None:
+        async def handle(request: web.Request) -> web.Response:
+            return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+        app = web.Application()
+        app.router.add_get("/metrics", handle)
+        self.metrics_runner = web.AppRunner(app, access_log=None)
+        await self.metrics_runner.setup()
+        await web.TCPSite(self.metrics_runner, METRICS_LISTEN, METRICS_PORT).start()
+        print(f"📈 指标地址 http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+
+    async def start_subscription_server(self) -> None:
+        app = web.Application()
+        app.router.add_get("/sub/{token}", self.serve_subscription)
+        self.subscription_runner = web.AppRunner(app, access_log=None)
+        await self.subscription_runner.setup()
+        await web.TCPSite(self.subscription_runner, SUBSCRIPTION_LISTEN, SUBSCRIPTION_PORT).start()
+        print(f"🔗 订阅服务 {self.subscription_base()}/sub/<token>")
+
+    @staticmethod
+    def subscription_base() -> str:
+        return (SUBSCRIPTION_URL or f"http://{SUBSCRIPTION_LISTEN}:{SUBSCRIPTION_PORT}").rstrip("/")
+
+    async def serve_subscription(self, request: web.Request) -> web.Response:
+        """Serve a subscription; polls that match the ETag get a bare 304."""
+        sub = self.subscriptions.get(request.match_info["token"])
+        if sub is None:
+            SUBSCRIPTION_REQUESTS.inc("unknown")
+            raise web.HTTPNotFound(text="unknown subscription")
+        served = self.served.get(sub.token)
+        digest = self.cached_digest(sub.gists)
+        if served is None or digest != served.digest:
+            try:
+                served = await self.refresh_subscription(sub.token, sub.gists, sub.apps, served)
+                SUBSCRIPTION_REQUESTS.inc("checked")
+            except GistError as e:
+                if served is None:
+                    SUBSCRIPTION_REQUESTS.inc("error")
+                    raise web.HTTPBadGateway(text=str(e))
+                # keep serving the last good config while the source is down
+                SUBSCRIPTION_REQUESTS.inc("stale")
+        headers = {
+            "ETag": served.etag,
+            "Last-Modified": served.http_date,
+            "Cache-Control": "no-cache",
+            "Vary": "Accept-Encoding",
+        }
+        if not_modified(request.headers, served):
+            SUBSCRIPTION_REQUESTS.inc("not_modified")
+            return web.Response(status=304, headers=headers)
+        SUBSCRIPTION_REQUESTS.inc("sent")
+        headers["Content-Disposition"] = "attachment; filename=clash.yaml"
+        body = served.data
+        if accepts_gzip(request.headers):
+            compressed = self.gzipped.get(served.key)
+            if compressed is None:
+                compressed = await self.offload(len(body), gzip.compress, body)
+                self.gzipped.put(served.key, compressed)
+            body = compressed
+            headers["Content-Encoding"] = "gzip"
+        return web.Response(body=body, content_type="text/yaml", charset="utf-8", headers=headers)
+
+    def cached_digest(self, urls: Sequence[str]) -> str | None:
+        """Digest of the sources if they are all in the fetch cache and fresh."""
+        parsed = [self.gist_cache.get(url) for url in urls]
+        now = time.monotonic()
+        if any(p is None or now - p.fetched_at >= CACHE_TTL for p in parsed):
+            return None
+        return sources_digest(parsed)
+
+    async def refresh_subscription(
+        self, token: str, gists: Sequence[str], apps: List[str], served: ServedConfig | None
+    ) -> ServedConfig:
+        """Revalidate the sources; re-render only if their digest changed."""
+        node_set = await self.fetch_sources(gists)
+        if served is None or node_set.digest != served.digest:
+            key, cached, _ = await self.render_nodes(node_set, apps, probe=False)
+            if served is None or key != served.key:
+                served = ServedConfig(node_set.digest, key, cached.data)
+            else:
+                served.digest = node_set.digest
+        self.served.put(token, served)
+        return served
+
+    async def save_rule_index(self) -> None:
+        if not self.domain_index.dirty:
+            return
+        try:
+            await asyncio.to_thread(self.domain_index.save, RULE_INDEX_PATH)
+        except OSError as e:
+            print(f"Failed to save {RULE_INDEX_PATH}: {e}")
+
+    async def preload_rule_index(self) -> None:
+        """Download every category once so /whichrule covers all of them."""
+        folders = [alias.get(app, app) for app in self.app_list]
+        _, errors = await self.rulesets.get_many(folders)
+        print(f"📚 规则索引已覆盖 {len(self.domain_index)} 个规则集，{len(errors)} 个下载失败")
+        await self.save_rule_index()
 
     def get_session(self, user_id: int) -> Session:
         s = self.sessions.get(user_id)
         if not s:
             s = Session()
             self.sessions[user_id] = s
-        s.last_active = asyncio.get_event_loop().time()
+        s.last_active = time.monotonic()
         return s
 
-    def build_keyboard(self, session: Session) -> InlineKeyboardMarkup:
-        if session.filter:
-            flt = session.filter.lower()
-            if session.prefix_filter:
-                items = [a for a in self.app_list if a.lower().startswith(flt)]
-            else:
-                items = [a for a in self.app_list if flt in a.lower()]
-        else:
-            items = self.app_list
+    def get_edit_session(self, user_id: int) -> EditSession | None:
+        es = self.edit_sessions.get(user_id)
+        if es:
+            es.last_active = time.monotonic()
+        return es
+
+    def sweep_sessions(self, now: float | None = None) -> int:
+        """Drop sessions idle for longer than SESSION_TTL; return how many."""
+        cutoff = (time.monotonic() if now is None else now) - SESSION_TTL
+        removed = 0
+        for name in ("sessions", "edit_sessions"):
+            store = getattr(self, name)
+            expired = [uid for uid, s in store.items() if s.last_active < cutoff]
+            if not expired:
+                continue
+            for uid in expired:
+                s = store.pop(uid)
+                if isinstance(s, Session):
+                    self.cancel_prefetch(s)
+            # dicts never shrink on delete; copy so the table is resized
+            setattr(self, name, dict(store))
+            removed += len(expired)
+        self.generate_limiter.prune()
+        if removed:
+            self.user_locks = {
+                uid: lock
+                for uid, lock in self.user_locks.items()
+                if lock.locked() or uid in self.sessions or uid in self.edit_sessions
+            }
+        return removed
+
+    @asynccontextmanager
+    async def user_state(self, user_id: int):
+        """Hold the user's lock and, with a shared store, load their sessions
+        before and write them back after."""
+        async with self.user_lock(user_id):
+            if self.store.shared:
+                try:
+                    await self.restore_user(user_id)
+                except Exception as e:
+                    # carry on with whatever this worker has in memory
+                    print(f"Failed to load session {user_id}: {e}")
+            try:
+                yield
+            finally:
+                if self.store.shared:
+                    try:
+                        await self.persist_user(user_id)
+                    except Exception as e:
+                        print(f"Failed to save session {user_id}: {e}")
+
+    async def restore_user(self, user_id: int) -> None:
+        data = await self.store.get(user_id)
+        state, edit_state = unpack(data) if data else (None, None)
+        local = self.sessions.pop(user_id, None)
+        if state is not None:
+            s = Session.from_state(state)
+            # a prefetch started here is still good if the links are the same
+            if local is not None and local.gists == s.gists:
+                s.prefetch = local.prefetch
+                local = None
+            self.sessions[user_id] = s
+        if local is not None:
+            self.cancel_prefetch(local)
+        self.edit_sessions.pop(user_id, None)
+        if edit_state is not None:
+            self.edit_sessions[user_id] = EditSession.from_state(edit_state)
+
+    async def persist_user(self, user_id: int) -> None:
+        s = self.sessions.get(user_id)
+        es = self.edit_sessions.get(user_id)
+        if s is None and es is None:
+            await self.store.delete(user_id)
+            return
+        state = [s.to_state() if s else None, es.to_state() if es else None]
+        await self.store.put(user_id, pack(state), SESSION_TTL)
+
+    def user_lock(self, user_id: int) -> asyncio.Lock:
+        """Serializes one user's updates; other users are not blocked."""
+        lock = self.user_locks.get(user_id)
+        if lock is None:
+            lock = self.user_locks[user_id] = asyncio.Lock()
+        return lock
+
+    def session_stats(self) -> Dict[str, int]:
+        return {
+            "sessions": len(self.sessions),
+            "edit_sessions": len(self.edit_sessions),
+            "approx_bytes": sys.getsizeof(self.sessions)
+            + sys.getsizeof(self.edit_sessions)
+            + sum(approx_session_size(s) for s in self.sessions.values())
+            + sum(approx_session_size(s) for s in self.edit_sessions.values()),
+        }
+
+    async def session_sweeper(self) -> None:
+        while True:
+            await asyncio.sleep(SESSION_SWEEP_INTERVAL)
+            removed = self.sweep_sessions()
+            self.prober.prune()
+            await self.save_rule_index()
+            try:
+                await self.store.purge()
+            except Exception as e:
+                print(f"Session store maintenance failed: {e}")
+            if removed:
+                stats = self.session_stats()
+                print(
+                    f"🧹 清理 {removed} 个过期会话，"
+                    f"当前 {stats['sessions']} 个会话 / {stats['edit_sessions']} 个编辑会话，"
+                    f"约 {stats['approx_bytes'] // 1024} KB"
+                )
+
+    def filtered_apps(self, session: Session | EditSession) -> Sequence[str]:
+        return self.index.search(session.filter, getattr(session, "prefix_filter", False))
+
+    def page_key(self, style: KeyboardStyle, session: Session | EditSession, items: Sequence[str]) -> tuple:
         start = session.page * PAGE_SIZE
         page_apps = items[start:start + PAGE_SIZE]
-        rows = [
-            [InlineKeyboardButton(
-                ("✅" if app in session.apps else "⬜️") + " " + app,
-                callback_data="TOGGLE_" + app,
-            )]
-            for app in page_apps
+        return (
+            style.toggle,
+            session.filter.lower() if session.filter else None,
+            getattr(session, "prefix_filter", False),
+            session.page,
+            frozenset(a for a in page_apps if a in session.apps),
+        )
+
+    def app_button(self, style: KeyboardStyle, app: str, checked: bool) -> InlineKeyboardButton:
+        key = (style.toggle, app, checked)
+        button = self.button_cache.get(key)
+        if button is None:
+            button = InlineKeyboardButton(
+                ("✅" if checked else "⬜️") + " " + app,
+                callback_data=style.toggle + app,
+            )
+            self.button_cache[key] = button
+        return button
+
+    def page_rows(
+        self, style: KeyboardStyle, session: Session | EditSession, items: Sequence[str], key: tuple
+    ) -> Tuple[Tuple[InlineKeyboardButton, ...], ...]:
+        rows = self.row_cache.get(key)
+        if rows is not None:
+            return rows
+        start = session.page * PAGE_SIZE
+        selected = key[-1]
+        built = [
+            (self.app_button(style, app, app in selected),)
+            for app in items[start:start + PAGE_SIZE]
         ]
         nav = []
         if session.page > 0:
-            nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data="PREV"))
+            nav.append(style.prev)
         if start + PAGE_SIZE < len(items):
-            nav.append(InlineKeyboardButton("下一页 ➡️", callback_data="NEXT"))
+            nav.append(style.next)
         if nav:
-            rows.append(nav)
+            built.append(tuple(nav))
+        rows = tuple(built)
+        self.row_cache.put(key, rows)
+        return rows
+
+    def group_rows(self, group_page: int) -> Tuple[Tuple[InlineKeyboardButton, ...], ...]:
+        rows = self.group_row_cache.get(group_page)
+        if rows is not None:
+            return rows
+        built = []
         group_names = list(self.groups.keys())
         if group_names:
-            gstart = session.group_page * GROUP_PAGE_SIZE
+            gstart = group_page * GROUP_PAGE_SIZE
             gslice = group_names[gstart:gstart + GROUP_PAGE_SIZE]
-            rows.append([
+            built.append(tuple(
                 InlineKeyboardButton(f"📂 {g}", callback_data="TOGGLE_GROUP_" + g)
                 for g in gslice
-            ])
+            ))
             if len(group_names) > GROUP_PAGE_SIZE:
                 gnav = []
-                if session.group_page > 0:
-                    gnav.append(InlineKeyboardButton("⬅️ 上一页", callback_data="GPREV"))
+                if group_page > 0:
+                    gnav.append(GROUP_PREV_BUTTON)
                 if gstart + GROUP_PAGE_SIZE < len(group_names):
-                    gnav.append(InlineKeyboardButton("下一页 ➡️", callback_data="GNEXT"))
+                    gnav.append(GROUP_NEXT_BUTTON)
                 if gnav:
-                    rows.append(gnav)
-        letters = []
-        r = []
-        for i, ch in enumerate(ALPHABET):
-            r.append(InlineKeyboardButton(ch, callback_data="LETTER_" + ch))
-            if (i + 1) % 7 == 0 or i == len(ALPHABET) - 1:
-                letters.append(r)
-                r = []
-        rows.extend(letters)
-        sr = [InlineKeyboardButton("🔍 搜索", callback_data="SEARCH")]
-        if session.filter:
-            sr.append(InlineKeyboardButton("❌ 清除", callback_data="CLEAR_FILTER"))
-        rows.append(sr)
-        rows.append([InlineKeyboardButton("✅ 生成配置", callback_data="GENERATE")])
-        return InlineKeyboardMarkup(rows)
+                    built.append(tuple(gnav))
+        rows = tuple(built)
+        self.group_row_cache[group_page] = rows
+        return rows
+
+    def build_keyboard(self, session: Session) -> InlineKeyboardMarkup:
+        with KEYBOARD_SECONDS.time("main"):
+            return self._build_keyboard(session)
+
+    def _build_keyboard(self, session: Session) -> InlineKeyboardMarkup:
+        items = self.filtered_apps(session)
+        key = self.page_key(MAIN_KEYBOARD, session, items)
+        markup = self.markup_cache.get((key, session.group_page))
+        if markup is not None:
+            return markup
+        rows = list(self.page_rows(MAIN_KEYBOARD, session, items, key))
+        rows.extend(self.group_rows(session.group_page))
+        rows.extend(LETTER_ROWS)
+        rows.append(MAIN_KEYBOARD.search_clear_row if session.filter else MAIN_KEYBOARD.search_row)
+        rows.extend(MAIN_KEYBOARD.footer)
+        markup = InlineKeyboardMarkup(rows)
+        self.markup_cache.put((key, session.group_page), markup)
+        return markup
 
     def build_edit_keyboard(self, session: EditSession) -> InlineKeyboardMarkup:
-        if session.filter:
-            flt = session.filter.lower()
-            items = [a for a in self.app_list if flt in a.lower()]
-        else:
-            items = self.app_list
-        start = session.page * PAGE_SIZE
-        page_apps = items[start:start + PAGE_SIZE]
-        rows = [
-            [InlineKeyboardButton(
-                ("✅" if app in session.apps else "⬜️") + " " + app,
-                callback_data="EG_TOGGLE_" + app,
-            )]
-            for app in page_apps
-        ]
-        nav = []
-        if session.page > 0:
-            nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data="EG_PREV"))
-        if start + PAGE_SIZE < len(items):
-            nav.append(InlineKeyboardButton("下一页 ➡️", callback_data="EG_NEXT"))
-        if nav:
-            rows.append(nav)
-        sr = [InlineKeyboardButton("🔍 搜索", callback_data="EG_SEARCH")]
-        if session.filter:
-            sr.append(InlineKeyboardButton("❌ 清除", callback_data="EG_CLEAR_FILTER"))
-        rows.append(sr)
-        rows.append([
-            InlineKeyboardButton("✅ 保存", callback_data="EG_SAVE"),
-            InlineKeyboardButton("取消", callback_data="EG_CANCEL"),
-        ])
-        return InlineKeyboardMarkup(rows)
+        with KEYBOARD_SECONDS.time("edit"):
+            return self._build_edit_keyboard(session)
+
+    def _build_edit_keyboard(self, session: EditSession) -> InlineKeyboardMarkup:
+        items = self.filtered_apps(session)
+        key = self.page_key(EDIT_KEYBOARD, session, items)
+        markup = self.markup_cache.get((key, None))
+        if markup is not None:
+            return markup
+        rows = list(self.page_rows(EDIT_KEYBOARD, session, items, key))
+        rows.append(EDIT_KEYBOARD.search_clear_row if session.filter else EDIT_KEYBOARD.search_row)
+        rows.extend(EDIT_KEYBOARD.footer)
+        markup = InlineKeyboardMarkup(rows)
+        self.markup_cache.put((key, None), markup)
+        return markup
+
+    async def send_keyboard(self, message, text: str, markup: InlineKeyboardMarkup) -> None:
+        sent = await message.reply_text(text, reply_markup=markup)
+        self.edits.seed(sent.chat_id, sent.message_id, markup)
+
+    def edit_markup(self, query, markup: InlineKeyboardMarkup | None) -> None:
+        """Queue a keyboard edit; bursts of taps collapse into one API call."""
+        msg = query.message
+        self.edits.submit(msg.chat_id, msg.message_id, markup, query.edit_message_reply_markup)
 
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         await update.message.reply_text(
@@ -352,6 +1214,10 @@ class BotApp:
                     "/addrules <名称> <规则...> - 向分组添加规则",
                     "/removerules <名称> <规则...> - 从分组移除规则",
                     "/editgroup <名称> - 使用按钮编辑分组",
+                    "/addgist <链接...> - 在当前会话中追加节点来源",
+                    "/whichrule <域名> - 查询哪些规则集包含该域名",
+                    "/subscribe - 为当前节点来源和所选规则生成订阅链接",
+                    "/unsubscribe - 作废你的所有订阅链接",
                 ]
             )
         )
@@ -374,7 +1240,7 @@ class BotApp:
             await update.message.reply_text("该分组已存在")
             return
         self.groups[name] = rules
-        save_groups(self.groups)
+        await self.store_groups(name)
         await update.message.reply_text(f"已创建分组 {name}")
 
     async def add_rules(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -389,7 +1255,7 @@ class BotApp:
         for r in rules:
             if r not in self.groups[name]:
                 self.groups[name].append(r)
-        save_groups(self.groups)
+        await self.store_groups(name)
         await update.message.reply_text(f"已更新分组 {name}")
 
     async def remove_rules(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -403,7 +1269,7 @@ class BotApp:
             await update.message.reply_text("分组不存在")
             return
         self.groups[name] = [r for r in self.groups[name] if r not in rules]
-        save_groups(self.groups)
+        await self.store_groups(name)
         await update.message.reply_text(f"已更新分组 {name}")
 
     async def edit_group(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -414,23 +1280,114 @@ class BotApp:
         name = args[1]
         rules = self.groups.get(name, [])
         s = EditSession(group=name, apps=set(rules))
-        self.edit_sessions[update.effective_user.id] = s
+        async with self.user_state(update.effective_user.id):
+            self.edit_sessions[update.effective_user.id] = s
+            await self.send_keyboard(
+                update.message,
+                f"正在编辑分组 {name}，勾选要包含的规则：",
+                self.build_edit_keyboard(s),
+            )
+
+    async def add_gist(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        links = extract_gist_links(update.message.text)
+        if not links:
+            await update.message.reply_text("用法: /addgist Gist链接...")
+            return
+        uid = update.effective_user.id
+        async with self.user_state(uid):
+            session = self.get_session(uid)
+            merged = tuple(dict.fromkeys(session.gists + tuple(links)))
+            if len(merged) > MAX_SOURCES:
+                await update.message.reply_text(f"最多支持 {MAX_SOURCES} 个来源")
+                return
+            session.gists = merged
+            self.start_prefetch(uid, session, context.bot)
+        await update.message.reply_text(f"已添加，当前共有 {len(merged)} 个节点来源")
+
+    async def cmd_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("该指令仅限管理员使用")
+            return
+        text = clip_text("\n".join(REGISTRY.summary()), MESSAGE_LIMIT)
+        await update.message.reply_text(text or "暂无数据")
+
+    async def subscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        if not SUBSCRIPTION_PORT:
+            await update.message.reply_text("未启用订阅服务")
+            return
+        uid = update.effective_user.id
+        async with self.user_state(uid):
+            session = self.get_session(uid)
+            if not session.gists:
+                await update.message.reply_text("请先发送 Gist 链接")
+                return
+            if not session.apps:
+                await update.message.reply_text("请先在按钮中选择至少一个规则")
+                return
+            sub = self.subscriptions.issue(uid, session.gists, session.apps)
+        await self.save_subscriptions()
         await update.message.reply_text(
-            f"正在编辑分组 {name}，勾选要包含的规则：",
-            reply_markup=self.build_edit_keyboard(s),
+            f"订阅链接（节点来源更新后客户端会自动获取新配置）：\n{self.subscription_base()}/sub/{sub.token}",
+            disable_web_page_preview=True,
         )
 
+    async def unsubscribe(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        tokens = self.subscriptions.revoke(update.effective_user.id)
+        for token in tokens:
+            self.served.pop(token)
+        if tokens:
+            await self.save_subscriptions()
+        await update.message.reply_text(f"已作废 {len(tokens)} 个订阅链接")
+
+    async def save_subscriptions(self) -> None:
+        try:
+            await asyncio.to_thread(self.subscriptions.save, self.subscriptions.snapshot())
+        except OSError as e:
+            print(f"Failed to save {SUBSCRIPTIONS_PATH}: {e}")
+
+    async def which_rule(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        args = update.message.text.split()
+        if len(args) < 2 or not normalize_domain(args[1]):
+            await update.message.reply_text("用法: /whichrule 域名")
+            return
+        domain = normalize_domain(args[1])
+        async with self.user_state(update.effective_user.id):
+            session = self.sessions.get(update.effective_user.id)
+            selected = {alias.get(app, app) for app in session.apps} if session else set()
+        if selected:
+            # make sure the user's own selection is covered
+            await self.rulesets.get_many(sorted(selected))
+        indexed = len(self.domain_index)
+        if not indexed:
+            await update.message.reply_text("规则索引为空，请先选择规则后再查询")
+            return
+        matches = self.domain_index.lookup(domain)
+        if not matches:
+            await update.message.reply_text(f"在已索引的 {indexed} 个规则集中没有规则匹配 {domain}")
+            return
+        lines = [f"{domain} 命中 {len(matches)} 个规则集（已索引 {indexed} 个）："]
+        for name, rule in matches[:MAX_LOOKUP_RESULTS]:
+            lines.append(f"{'✅' if name in selected else '•'} {name} — {rule}")
+        if len(matches) > MAX_LOOKUP_RESULTS:
+            lines.append(f"……另有 {len(matches) - MAX_LOOKUP_RESULTS} 个")
+        await update.message.reply_text("\n".join(lines))
+
     async def on_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        async with self.user_state(update.effective_user.id):
+            await self.handle_text(update, context)
+
+    async def handle_text(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         text = update.message.text.strip()
         uid = update.effective_user.id
-        if uid in self.edit_sessions and self.edit_sessions[uid].awaiting_search:
-            s = self.edit_sessions[uid]
+        s = self.get_edit_session(uid)
+        if s and s.awaiting_search:
             s.filter = text
             s.page = 0
             s.awaiting_search = False
-            await update.message.reply_text(
+            await self.send_keyboard(
+                update.message,
                 f"已根据关键词“{text}”过滤：",
-                reply_markup=self.build_edit_keyboard(s),
+                self.build_edit_keyboard(s),
             )
             return
         session = self.get_session(uid)
@@ -440,26 +1397,46 @@ class BotApp:
             session.group_page = 0
             session.prefix_filter = False
             session.awaiting_search = False
-            await update.message.reply_text(
+            await self.send_keyboard(
+                update.message,
                 f"已根据关键词“{text}”过滤：",
-                reply_markup=self.build_keyboard(session),
+                self.build_keyboard(session),
             )
             return
-        if "gist.github" not in text and "raw.githubusercontent" not in text:
+        links = extract_gist_links(text)
+        if not links:
             await update.message.reply_text("这看起来不是 Gist 链接，请重新发送。")
             return
-        session.gist = text
+        session.gists = tuple(dict.fromkeys(links))[:MAX_SOURCES]
         session.apps.clear()
         session.page = 0
         session.filter = None
         session.group_page = 0
         session.prefix_filter = False
-        await update.message.reply_text(
+        self.start_prefetch(uid, session, context.bot)
+        await self.send_keyboard(
+            update.message,
             "好的！请选择要启用的分流规则（可多选）：",
-            reply_markup=self.build_keyboard(session),
+            self.build_keyboard(session),
         )
 
     async def on_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        uid = update.effective_user.id
+        t0 = time.perf_counter()
+        async with self.user_state(uid):
+            session = await self.handle_action(update, context)
+        ACTION_SECONDS.observe(time.perf_counter() - t0, action_label(update.callback_query.data))
+        if session is not None:
+            # generation runs outside the lock so the keyboard stays responsive
+            try:
+                async with self.generate_slots:
+                    with GENERATE_SECONDS.time():
+                        await self.generate(uid, session, context)
+            finally:
+                self.generating.discard(uid)
+
+    async def handle_action(self, update: Update, context: ContextTypes.DEFAULT_TYPE) -> Session | None:
+        """Apply a button press; returns the session to generate for GENERATE."""
         query = update.callback_query
         await query.answer()
         data = query.data
@@ -481,71 +1458,71 @@ class BotApp:
                     session.apps.remove(app)
                 else:
                     session.apps.add(app)
-            await query.edit_message_reply_markup(self.build_keyboard(session))
+            self.edit_markup(query, self.build_keyboard(session))
         elif data.startswith("EG_TOGGLE_"):
-            es = self.edit_sessions.get(uid)
+            es = self.get_edit_session(uid)
             if es:
                 app = data[len("EG_TOGGLE_") :]
                 if app in es.apps:
                     es.apps.remove(app)
                 else:
                     es.apps.add(app)
-                await query.edit_message_reply_markup(self.build_edit_keyboard(es))
+                self.edit_markup(query, self.build_edit_keyboard(es))
         elif data == "EG_NEXT":
-            es = self.edit_sessions.get(uid)
-            if es and (es.page + 1) * PAGE_SIZE < len(self.app_list):
+            es = self.get_edit_session(uid)
+            if es and (es.page + 1) * PAGE_SIZE < len(self.filtered_apps(es)):
                 es.page += 1
-                await query.edit_message_reply_markup(self.build_edit_keyboard(es))
+                self.edit_markup(query, self.build_edit_keyboard(es))
         elif data == "EG_PREV":
-            es = self.edit_sessions.get(uid)
+            es = self.get_edit_session(uid)
             if es and es.page > 0:
                 es.page -= 1
-                await query.edit_message_reply_markup(self.build_edit_keyboard(es))
+                self.edit_markup(query, self.build_edit_keyboard(es))
         elif data == "EG_SEARCH":
-            es = self.edit_sessions.get(uid)
+            es = self.get_edit_session(uid)
             if es:
                 es.awaiting_search = True
                 await query.answer("请输入关键词发送给我")
         elif data == "EG_CLEAR_FILTER":
-            es = self.edit_sessions.get(uid)
+            es = self.get_edit_session(uid)
             if es and es.filter:
                 es.filter = None
                 es.page = 0
-                await query.edit_message_reply_markup(self.build_edit_keyboard(es))
+                self.edit_markup(query, self.build_edit_keyboard(es))
         elif data == "EG_SAVE":
-            es = self.edit_sessions.get(uid)
+            es = self.get_edit_session(uid)
             if es:
                 self.groups[es.group] = list(es.apps)
-                save_groups(self.groups)
+                await self.store_groups(es.group)
                 del self.edit_sessions[uid]
-                await query.edit_message_reply_markup(None)
+                self.edit_markup(query, None)
                 await context.bot.send_message(uid, f"分组 {es.group} 已保存")
         elif data == "EG_CANCEL":
             if uid in self.edit_sessions:
                 g = self.edit_sessions[uid].group
                 del self.edit_sessions[uid]
-                await query.edit_message_reply_markup(None)
+                self.edit_markup(query, None)
                 await context.bot.send_message(uid, f"已取消编辑 {g}")
         elif data == "NEXT":
             session = self.get_session(uid)
-            if (session.page + 1) * PAGE_SIZE < len(self.app_list):
+            if (session.page + 1) * PAGE_SIZE < len(self.filtered_apps(session)):
                 session.page += 1
-                await query.edit_message_reply_markup(self.build_keyboard(session))
+                self.edit_markup(query, self.build_keyboard(session))
         elif data == "PREV":
             session = self.get_session(uid)
             if session.page > 0:
                 session.page -= 1
-                await query.edit_message_reply_markup(self.build_keyboard(session))
+                self.edit_markup(query, self.build_keyboard(session))
         elif data == "GNEXT":
             session = self.get_session(uid)
             if (session.group_page + 1) * GROUP_PAGE_SIZE < len(self.groups):
                 session.group_page += 1
-                await query.edit_message_reply_markup(self.build_keyboard(session))
+                self.edit_markup(query, self.build_keyboard(session))
         elif data == "GPREV":
             session = self.get_session(uid)
             if session.group_page > 0:
                 session.group_page -= 1
-                await query.edit_message_reply_markup(self.build_keyboard(session))
+                self.edit_markup(query, self.build_keyboard(session))
         elif data.startswith("LETTER_"):
             letter = data[len("LETTER_") :]
             session = self.get_session(uid)
@@ -553,7 +1530,7 @@ class BotApp:
             session.prefix_filter = True
             session.page = 0
             session.group_page = 0
-            await query.edit_message_reply_markup(self.build_keyboard(session))
+            self.edit_markup(query, self.build_keyboard(session))
         elif data == "SEARCH":
             session = self.get_session(uid)
             session.awaiting_search = True
@@ -565,47 +1542,270 @@ class BotApp:
                 session.page = 0
                 session.group_page = 0
                 session.prefix_filter = False
-                await query.edit_message_reply_markup(self.build_keyboard(session))
+                self.edit_markup(query, self.build_keyboard(session))
         elif data == "GENERATE":
             session = self.get_session(uid)
-            if not session.gist:
+            if not session.gists:
                 await query.answer("请先发送 Gist 链接")
                 return
             if not session.apps:
                 await query.answer("至少选择一个规则")
                 return
-            await query.answer("开始生成，请稍候…")
-            try:
-                raw = await fetch_gist_raw(session.gist, GITHUB_TOKEN)
-            except Exception as e:
-                await context.bot.send_message(uid, f"获取Gist内容失败: {e}")
+            # the query is already answered above, so notices go out as messages
+            if uid in self.generating:
+                GENERATE_REJECTED.inc("busy")
+                await self.notify(context.bot, uid, "上一份配置还在生成中，请稍候")
                 return
-            nodes = []
-            for line in raw.splitlines():
-                if not line:
-                    continue
+            wait = self.generate_limiter.acquire(uid)
+            if wait:
+                GENERATE_REJECTED.inc("rate")
+                await self.notify(context.bot, uid, f"操作太频繁，请 {wait:.0f} 秒后再试")
+                return
+            try:
+                await query.answer("开始生成，请稍候…")
+            except TelegramError:
+                pass
+            # added last: on_action only discards it once handle_action returns
+            self.generating.add(uid)
+            return session
+        return None
+
+    async def fetch_and_parse(self, url: str) -> ParsedGist:
+        cached = self.gist_cache.get(url)
+        if cached is not None and time.monotonic() - cached.fetched_at < CACHE_TTL:
+            return cached
+        # everyone asking for the same Gist meanwhile waits for this download
+        if url in self.fetch_flights:
+            COALESCED.inc("fetch")
+        return await self.fetch_flights.run(url, lambda: self._fetch_and_parse(url))
+
+    async def _fetch_and_parse(self, url: str) -> ParsedGist:
+        cached = self.gist_cache.get(url)
+        t0 = time.perf_counter()
+        try:
+            parsed = await fetch_gist_nodes(
+                self.http, url, GITHUB_TOKEN, etag=cached.etag if cached else None
+            )
+        except GistError:
+            GIST_FETCH_SECONDS.observe(time.perf_counter() - t0, "error")
+            raise
+        except Exception as e:
+            GIST_FETCH_SECONDS.observe(time.perf_counter() - t0, "error")
+            raise GistError(f"获取Gist内容失败: {e}") from e
+        GIST_FETCH_SECONDS.observe(time.perf_counter() - t0, "not_modified" if parsed is None else "ok")
+        if parsed is None:
+            cached.fetched_at = time.monotonic()
+            return cached
+        if not parsed.nodes:
+            message = "没有解析到有效节点"
+            if parsed.report.error_count:
+                message += "\n" + parsed.report.summary()
+            raise GistError(message)
+        self.gist_cache.put(url, parsed)
+        return parsed
+
+    async def fetch_sources(self, urls: Sequence[str]) -> NodeSet:
+        """Fetch every source concurrently and merge the nodes.
+
+        Fails only when no source produced any nodes.
+        """
+
+        async def one(url: str) -> Tuple[SourceStat, ParsedGist | None]:
+            async with self.fetch_slots:
+                t0 = time.monotonic()
                 try:
-                    node = parse_node_line(line)
-                except Exception as e:
-                    await context.bot.send_message(uid, f"解析节点失败: {e}")
-                    return
-                if any(k in node.name for k in ["剩余流量", "距离下次重置剩余", "套餐到期"]):
-                    continue
-                nodes.append(node)
-            yaml_str = build_yaml(nodes, list(session.apps))
-            await context.bot.send_document(
+                    parsed = await self.fetch_and_parse(url)
+                except GistError as e:
+                    return SourceStat(url, time.monotonic() - t0, error=str(e)), None
+                stat = SourceStat(
+                    url, time.monotonic() - t0, len(parsed.nodes), parsed.report.error_count
+                )
+                return stat, parsed
+
+        results = await asyncio.gather(*(one(u) for u in urls))
+        if all(p is None for _, p in results):
+            raise GistError("\n".join(stat.error for stat, _ in results))
+        return merge_sources(results)
+
+    async def prefetch_sources(self, uid: int, urls: Sequence[str], bot) -> NodeSet | None:
+        """Fetch and parse while the user is still picking rules.
+
+        Problems are reported right away; on failure GENERATE tries again.
+        """
+        try:
+            node_set = await self.fetch_sources(urls)
+        except GistError as e:
+            await self.notify(bot, uid, str(e))
+            return None
+        for n, src in enumerate(node_set.sources, 1):
+            label = f"来源 {n}：" if len(urls) > 1 else ""
+            if src.error:
+                await self.notify(bot, uid, label + src.error)
+            elif src.bad_lines:
+                parsed = self.gist_cache.get(src.url)
+                if parsed is not None:
+                    await self.notify(bot, uid, label + parsed.report.summary())
+        return node_set
+
+    @staticmethod
+    async def notify(bot, uid: int, text: str) -> None:
+        """Best-effort message from a background task."""
+        try:
+            await bot.send_message(uid, clip_text(text, MESSAGE_LIMIT))
+        except TelegramError as e:
+            print(f"Failed to notify {uid}: {e}")
+
+    def start_prefetch(self, uid: int, session: Session, bot) -> None:
+        self.cancel_prefetch(session)
+        session.prefetch = asyncio.create_task(self.prefetch_sources(uid, session.gists, bot))
+
+    @staticmethod
+    def cancel_prefetch(session: Session) -> None:
+        if session.prefetch is not None:
+            if not session.prefetch.done():
+                session.prefetch.cancel()
+            session.prefetch = None
+
+    async def session_nodes(self, session: Session) -> NodeSet:
+        task = session.prefetch
+        if task is not None:
+            if not task.done():
+                await asyncio.wait([task])
+            if not task.cancelled() and task.exception() is None:
+                node_set = task.result()
+                if node_set is not None and time.monotonic() - node_set.fetched_at < CACHE_TTL:
+                    return node_set
+            elif not task.cancelled():
+                print(f"Prefetch failed, fetching again: {task.exception()!r}")
+        # no prefetch, it failed, or its result is older than the fetch cache
+        return await self.fetch_sources(session.gists)
+
+    async def generate(self, uid: int, session: Session, context: ContextTypes.DEFAULT_TYPE) -> None:
+        apps = sorted(session.apps)
+        try:
+            node_set = await self.session_nodes(session)
+        except GistError as e:
+            await context.bot.send_message(uid, str(e))
+            return
+        key, cached, caption = await self.render_nodes(node_set, apps)
+        failures = node_set.failures()
+        if failures:
+            await context.bot.send_message(uid, clip_text(failures, MESSAGE_LIMIT))
+        await self.send_config(uid, key, cached, context, caption)
+
+    async def render_nodes(
+        self, node_set: NodeSet, apps: List[str], probe: bool = True
+    ) -> Tuple[str, CachedConfig, str]:
+        """Return the config for ``apps`` from the cache or freshly rendered,
+        with its cache key and the caption for the user."""
+        nodes = node_set.nodes
+        options = [GENERATOR_VERSION, YAML_EMITTER, repr(GROUP_LAYOUT)]
+        caption = node_set.caption()
+        if probe and PROBE_MODE in ("drop", "demote"):
+            results = await self.prober.probe(zip(nodes.hosts, nodes.ports))
+            nodes, alive, dead = rank_nodes(nodes, results, PROBE_MODE == "drop")
+            # the output now depends on the probe, so key on the resulting order
+            options += [PROBE_MODE, hashlib.sha256("\n".join(nodes.names).encode("utf-8")).hexdigest()]
+            if dead:
+                action = "已移除" if len(nodes) < len(node_set.nodes) else "已排在最后"
+                caption += f"\n探测：{alive} 个可达，{dead} 个不可达（{action}）"
+            else:
+                caption += f"\n探测：{alive} 个可达"
+        rule_sets = None
+        size = node_set.size
+        if RULE_PROVIDERS == "inline":
+            rule_sets, digests, failed = await self.load_rule_sets(apps)
+            options += ["inline", *digests]
+            size += sum(len(r) for r in rule_sets.values()) * 32
+            if failed:
+                listed = "、".join(failed[:MAX_LISTED_RULE_SETS])
+                if len(failed) > MAX_LISTED_RULE_SETS:
+                    listed += " 等"
+                caption += f"\n{len(failed)} 个规则集下载失败，改为远程加载：{listed}"
+        key = config_key(node_set.digest, apps, *options)
+        if key in self.render_flights:
+            COALESCED.inc("render")
+        cached = await self.render_flights.run(
+            key, lambda: self.cached_or_render(key, size, nodes, apps, rule_sets)
+        )
+        return key, cached, caption
+
+    async def cached_or_render(
+        self, key: str, size: int, nodes: NodeStore, apps: List[str], rule_sets: Dict[str, List[str]] | None
+    ) -> CachedConfig:
+        cached = await self.configs.get(key)
+        CONFIG_CACHE_LOOKUPS.inc("miss" if cached is None else "hit")
+        if cached is None:
+            with RENDER_SECONDS.time():
+                data = await self.offload(size, render_config, nodes, apps, GROUP_LAYOUT, rule_sets)
+            CONFIG_BYTES.observe(len(data))
+            CONFIG_NODES.observe(len(nodes))
+            cached = await self.configs.put(key, data)
+        return cached
+
+    async def load_rule_sets(self, apps: List[str]) -> Tuple[Dict[str, List[str]], List[str], List[str]]:
+        """Rules of each app for inline providers, the digests of the rule
+        files they came from, and the apps whose file could not be loaded."""
+        folders = {app: alias.get(app, app) for app in apps}
+        loaded, errors = await self.rulesets.get_many(folders.values())
+        for folder, err in errors.items():
+            print(f"Failed to load rule set {folder}: {err}")
+        rule_sets = {app: loaded[f].rules for app, f in folders.items() if f in loaded}
+        digests = [f"{app}={loaded[f].digest if f in loaded else '-'}" for app, f in folders.items()]
+        failed = [app for app, f in folders.items() if f not in loaded]
+        return rule_sets, digests, failed
+
+    async def send_config(
+        self,
+        uid: int,
+        key: str,
+        cached: CachedConfig,
+        context: ContextTypes.DEFAULT_TYPE,
+        caption: str = "配置生成成功 🎉",
+    ) -> None:
+        caption = clip_text(caption, CAPTION_LIMIT)
+        if cached.file_id:
+            try:
+                with TELEGRAM_SECONDS.time("send_document_by_id"):
+                    await context.bot.send_document(uid, cached.file_id, caption=caption)
+                return
+            except BadRequest:
+                cached.file_id = None
+        with TELEGRAM_SECONDS.time("send_document"):
+            msg = await context.bot.send_document(
                 uid,
-                InputFile.from_bytes(yaml_str.encode("utf-8"), filename="clash.yaml"),
-                caption="配置生成成功 🎉",
+                InputFile(cached.data, filename="clash.yaml"),
+                caption=caption,
             )
+        if msg.document:
+            await self.configs.set_file_id(key, msg.document.file_id)
+
+    async def offload(self, size: int, fn, *args):
+        """Run CPU-bound work off the event loop unless the input is small."""
+        if size < GENERATE_INLINE_BYTES:
+            return fn(*args)
+        if self.executor is None:
+            if GENERATE_EXECUTOR == "process":
+                self.executor = ProcessPoolExecutor(GENERATE_WORKERS)
+            else:
+                self.executor = ThreadPoolExecutor(GENERATE_WORKERS, thread_name_prefix="generate")
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self.executor, fn, *args)
 
     def run(self) -> None:
-        """Load initial data and start polling."""
-        asyncio.run(self.load_initial())
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
+        """Start polling, or serve a webhook when WEBHOOK_URL is set; initial
+        data is loaded by the post-init hook."""
         print("🤖 Telegram Bot 已启动")
-        self.app.run_polling()
+        if WEBHOOK_URL:
+            self.app.run_webhook(
+                listen=WEBHOOK_LISTEN,
+                port=WEBHOOK_PORT,
+                url_path=WEBHOOK_PATH,
+                webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+                secret_token=WEBHOOK_SECRET,
+            )
+        else:
+            self.app.run_polling()
 
 
 if __name__ == "__main__":
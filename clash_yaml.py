@@ -0,0 +1,81 @@
+import re
+from typing import Any, Dict, Iterator
+
+import yaml
+
+try:
+    from yaml import CSafeDumper as _CSafeDumper
+except ImportError:  # PyYAML built without libyaml
+    _CSafeDumper = None
+
+# Strings that a YAML 1.1 loader reads back as the same string when written
+# unquoted, in both block and flow context.
+_PLAIN = re.compile(r"[^\W\d][\w.\-]*")
+_RESERVED = frozenset(
+    "yes Yes YES no No NO true True TRUE false False FALSE on On ON off Off OFF null Null NULL".split()
+)
+_ESCAPE = re.compile("[\"\\\\\x00-\x1f\x7f-\x9f\u2028\u2029\ufeff\ud800-\udfff]")
+_NAMED_ESCAPES = {'"': '\\"', "\\": "\\\\", "\n": "\\n", "\t": "\\t", "\r": "\\r", "\x00": "\\0"}
+
+
+def _escape(m: "re.Match[str]") -> str:
+    ch = m.group()
+    return _NAMED_ESCAPES.get(ch) or f"\\u{ord(ch):04x}"
+
+
+def scalar(value: Any) -> str:
+    if value is None:
+        return "null"
+    if value is True:
+        return "true"
+    if value is False:
+        return "false"
+    if isinstance(value, int):
+        return str(value)
+    s = str(value)
+    if _PLAIN.fullmatch(s) and s not in _RESERVED:
+        return s
+    return '"' + _ESCAPE.sub(_escape, s) + '"'
+
+
+def flow(value: Any) -> str:
+    if isinstance(value, dict):
+        return "{" + ", ".join(f"{scalar(k)}: {flow(v)}" for k, v in value.items()) + "}"
+    if isinstance(value, (list, tuple)):
+        return "[" + ", ".join(flow(v) for v in value) + "]"
+    return scalar(value)
+
+
+def iter_clash_yaml(config: Dict[str, Any]) -> Iterator[str]:
+    """Yield the document line by line.
+
+    Top-level keys are block style, sequence items (proxies, proxy groups,
+    rules) and mapping values (rule providers) are written one flow node per
+    line, which is all the Clash schema needs.
+    """
+    for key, value in config.items():
+        k = scalar(key)
+        if isinstance(value, dict) and value:
+            yield f"{k}:\n"
+            for sub, item in value.items():
+                yield f"  {scalar(sub)}: {flow(item)}\n"
+        elif isinstance(value, (list, tuple)) and value:
+            yield f"{k}:\n"
+            for item in value:
+                yield f"- {flow(item)}\n"
+        else:
+            yield f"{k}: {flow(value)}\n"
+
+
+def emit_clash_yaml(config: Dict[str, Any]) -> str:
+    return "".join(iter_clash_yaml(config))
+
+
+def dump_config(config: Dict[str, Any], emitter: str = "libyaml") -> str:
+    """Serialize with libyaml when available, else with the streaming emitter.
+
+    Pass ``emitter="streaming"`` to always use the streaming emitter.
+    """
+    if emitter != "streaming" and _CSafeDumper is not None:
+        return yaml.dump(config, Dumper=_CSafeDumper, sort_keys=False, allow_unicode=True)
+    return emit_clash_yaml(config)
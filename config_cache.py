@@ -0,0 +1,113 @@
+import asyncio
+import hashlib
+import os
+from dataclasses import dataclass
+from typing import Iterable
+
+from util import LRUCache, atomic_write
+
+
+@dataclass(slots=True)
+class CachedConfig:
+    data: bytes
+    file_id: str | None = None
+
+
+def config_key(body_digest: str, apps: Iterable[str], *options: str) -> str:
+    """Content address of a generated config.
+
+    ``body_digest`` is the hex SHA-256 of the Gist body; ``options`` carries
+    anything else that changes the output, starting with the generator
+    version.
+    """
+    h = hashlib.sha256(body_digest.encode("ascii"))
+    h.update("\0".join(sorted(apps)).encode("utf-8"))
+    for opt in options:
+        h.update(b"\1" + opt.encode("utf-8"))
+    return h.hexdigest()
+
+
+class ConfigCache:
+    """Generated configs by content address: an in-memory LRU in front of an
+    optional directory of ``<key>.yaml`` files trimmed to ``max_disk_bytes``.
+
+    The Telegram ``file_id`` of the first upload is kept next to the bytes
+    (``<key>.fid`` on disk) so later hits can be re-sent without uploading.
+    """
+
+    def __init__(self, max_entries: int = 64, directory: str | None = None, max_disk_bytes: int = 64 << 20):
+        self.directory = directory or None
+        self.max_disk_bytes = max_disk_bytes
+        self._entries = LRUCache(max_entries)
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+    def _path(self, key: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{key}.{ext}")
+
+    async def get(self, key: str) -> CachedConfig | None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            return entry
+        if not self.directory:
+            return None
+        entry = await asyncio.to_thread(self._load, key)
+        if entry is not None:
+            self._entries.put(key, entry)
+        return entry
+
+    async def put(self, key: str, data: bytes) -> CachedConfig:
+        entry = CachedConfig(data)
+        self._entries.put(key, entry)
+        if self.directory:
+            await asyncio.to_thread(self._store, key, data)
+        return entry
+
+    async def set_file_id(self, key: str, file_id: str) -> None:
+        entry = self._entries.get(key)
+        if entry is not None:
+            entry.file_id = file_id
+        if self.directory:
+            await asyncio.to_thread(atomic_write, self._path(key, "fid"), file_id.encode("ascii"))
+
+    def _load(self, key: str) -> CachedConfig | None:
+        path = self._path(key, "yaml")
+        try:
+            with open(path, "rb") as f:
+                data = f.read()
+            os.utime(path)
+        except OSError:
+            return None
+        try:
+            with open(self._path(key, "fid"), "r", encoding="ascii") as f:
+                file_id = f.read().strip() or None
+        except OSError:
+            file_id = None
+        return CachedConfig(data, file_id)
+
+    def _store(self, key: str, data: bytes) -> None:
+        atomic_write(self._path(key, "yaml"), data)
+        self._trim()
+
+    def _trim(self) -> None:
+        files = []
+        total = 0
+        with os.scandir(self.directory) as it:
+            for e in it:
+                if e.name.endswith(".yaml") and e.is_file():
+                    st = e.stat()
+                    files.append((st.st_mtime, st.st_size, e.name[:-5]))
+                    total += st.st_size
+        files.sort()
+        for _, size, key in files:
+            if total <= self.max_disk_bytes:
+                break
+            for ext in ("yaml", "fid"):
+                try:
+                    os.remove(self._path(key, ext))
+                except OSError:
+                    pass
+            total -= size
@@ -0,0 +1,171 @@
+import json
+import re
+import threading
+from typing import Any, Dict, List, Tuple
+
+from rulesets import RuleSet
+from util import atomic_write
+
+INDEX_VERSION = 1
+
+# trie nodes are plain dicts keyed by domain label, from the TLD down; these
+# keys hold the ids of the rule sets with a DOMAIN-SUFFIX / DOMAIN rule there
+SUFFIX = "$s"
+EXACT = "$d"
+
+
+def normalize_domain(text: str) -> str:
+    """Host part of a domain or URL, lowercased and without a trailing dot."""
+    text = text.strip().lower()
+    if "://" in text:
+        text = text.split("://", 1)[1]
+    text = text.split("/", 1)[0].split("?", 1)[0].rsplit("@", 1)[-1]
+    if not text.startswith("["):
+        text = text.split(":", 1)[0]
+    return text.rstrip(".")
+
+
+class DomainIndex:
+    """Which rule sets match a domain.
+
+    DOMAIN and DOMAIN-SUFFIX rules go into a label trie, DOMAIN-KEYWORD and
+    DOMAIN-REGEX rules into side tables. The structures are JSON-native, so
+    the index is saved and loaded as is, without a rebuild. Rule sets are
+    added one at a time; re-adding a set with a new digest replaces it.
+
+    ``add`` and ``save`` may run in worker threads and are serialized by a
+    lock; ``lookup`` only reads and runs on the event loop.
+    """
+
+    def __init__(self):
+        self.sets: List[List[str]] = []  # [name, digest] by id
+        self.trie: Dict[str, Any] = {}
+        self.keywords: Dict[str, List[int]] = {}
+        self.regexes: List[Tuple[str, int]] = []
+        self.dirty = False
+        self._ids: Dict[str, int] = {}
+        self._compiled: List[Tuple[re.Pattern, str, int]] = []
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return sum(1 for _, digest in self.sets if digest)
+
+    @classmethod
+    def load(cls, path: str) -> "DomainIndex":
+        index = cls()
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+        except (OSError, ValueError):
+            return index
+        if data.get("version") != INDEX_VERSION:
+            return index
+        index.sets = data["sets"]
+        index.trie = data["trie"]
+        index.keywords = data["keywords"]
+        index.regexes = [tuple(r) for r in data["regexes"]]
+        index._ids = {name: i for i, (name, _) in enumerate(index.sets)}
+        index._compile()
+        return index
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            data = json.dumps(
+                {
+                    "version": INDEX_VERSION,
+                    "sets": self.sets,
+                    "trie": self.trie,
+                    "keywords": self.keywords,
+                    "regexes": self.regexes,
+                },
+                ensure_ascii=False,
+                separators=(",", ":"),
+            )
+            self.dirty = False
+        atomic_write(path, data)
+
+    def _compile(self) -> None:
+        compiled = []
+        for pattern, sid in self.regexes:
+            try:
+                compiled.append((re.compile(pattern), pattern, sid))
+            except re.error:
+                continue
+        self._compiled = compiled
+
+    def _discard(self, sid: int) -> None:
+        stack = [self.trie]
+        while stack:
+            node = stack.pop()
+            for key in (SUFFIX, EXACT):
+                ids = node.get(key)
+                if ids and sid in ids:
+                    ids.remove(sid)
+                    if not ids:
+                        del node[key]
+            stack.extend(v for k, v in node.items() if k not in (SUFFIX, EXACT))
+        for kw in [kw for kw, ids in self.keywords.items() if sid in ids]:
+            self.keywords[kw].remove(sid)
+            if not self.keywords[kw]:
+                del self.keywords[kw]
+        self.regexes = [r for r in self.regexes if r[1] != sid]
+
+    def add(self, rule_set: RuleSet) -> bool:
+        """Index ``rule_set``; False if this version is already indexed."""
+        with self._lock:
+            sid = self._ids.get(rule_set.name)
+            if sid is None:
+                sid = len(self.sets)
+                self.sets.append([rule_set.name, ""])
+                self._ids[rule_set.name] = sid
+            elif self.sets[sid][1] == rule_set.digest:
+                return False
+            else:
+                self._discard(sid)
+            for rule in rule_set.rules:
+                kind, _, rest = rule.partition(",")
+                value = rest.split(",", 1)[0].strip()
+                if not value:
+                    continue
+                if kind in ("DOMAIN-SUFFIX", "DOMAIN"):
+                    node = self.trie
+                    for label in reversed(value.lower().strip(".").split(".")):
+                        node = node.setdefault(label, {})
+                    ids = node.setdefault(SUFFIX if kind == "DOMAIN-SUFFIX" else EXACT, [])
+                    if sid not in ids:
+                        ids.append(sid)
+                elif kind == "DOMAIN-KEYWORD":
+                    ids = self.keywords.setdefault(value.lower(), [])
+                    if sid not in ids:
+                        ids.append(sid)
+                elif kind == "DOMAIN-REGEX":
+                    self.regexes.append((value, sid))
+            self.sets[sid][1] = rule_set.digest
+            self._compile()
+            self.dirty = True
+            return True
+
+    def lookup(self, domain: str) -> List[Tuple[str, str]]:
+        """``(rule set, matching rule)`` pairs for ``domain``, one per set."""
+        domain = normalize_domain(domain)
+        labels = domain.split(".")
+        found: Dict[int, str] = {}
+        node = self.trie
+        for depth, label in enumerate(reversed(labels), 1):
+            node = node.get(label)
+            if node is None:
+                break
+            suffix = ".".join(labels[-depth:])
+            for sid in node.get(SUFFIX, ()):
+                found.setdefault(sid, f"DOMAIN-SUFFIX,{suffix}")
+            if depth == len(labels):
+                for sid in node.get(EXACT, ()):
+                    found.setdefault(sid, f"DOMAIN,{suffix}")
+        for kw, ids in list(self.keywords.items()):
+            if kw in domain:
+                for sid in ids:
+                    found.setdefault(sid, f"DOMAIN-KEYWORD,{kw}")
+        for regex, pattern, sid in self._compiled:
+            if sid not in found and regex.search(domain):
+                found[sid] = f"DOMAIN-REGEX,{pattern}"
+        return sorted((self.sets[sid][0], rule) for sid, rule in found.items())
@@ -0,0 +1,126 @@
+import asyncio
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import Awaitable, Callable, Dict, Tuple
+
+from telegram import InlineKeyboardMarkup
+from telegram.error import BadRequest, RetryAfter, TelegramError
+
+from metrics import TELEGRAM_SECONDS
+
+EditFn = Callable[[InlineKeyboardMarkup | None], Awaitable]
+
+_UNKNOWN = object()
+
+
+def markup_hash(markup: InlineKeyboardMarkup | None) -> int | None:
+    return None if markup is None else hash(markup)
+
+
+@dataclass(slots=True)
+class _Slot:
+    markup: InlineKeyboardMarkup | None = None
+    edit: EditFn | None = None
+    sent_hash: object = _UNKNOWN
+    task: asyncio.Task | None = None
+
+
+class EditCoalescer:
+    """Debounces reply-markup edits per message and sends only the latest one.
+
+    Handlers hand over the freshly rendered markup and return immediately; a
+    per-message task waits ``delay`` seconds, then edits once with whatever
+    markup is newest at that point. Edits whose markup hashes the same as the
+    one already on screen are dropped, and a ``RetryAfter`` from Telegram
+    pauses every edit for that chat until the flood window has passed.
+    """
+
+    def __init__(self, delay: float = 0.3, max_messages: int = 4096):
+        self.delay = delay
+        self.max_messages = max_messages
+        self._slots: "OrderedDict[Tuple[int, int], _Slot]" = OrderedDict()
+        self._blocked_until: Dict[int, float] = {}
+        self.stats = {"submitted": 0, "sent": 0, "skipped": 0, "retry_after": 0, "failed": 0}
+
+    def _slot(self, chat_id: int, message_id: int) -> _Slot:
+        key = (chat_id, message_id)
+        slot = self._slots.get(key)
+        if slot is None:
+            slot = _Slot()
+            self._slots[key] = slot
+            self._evict()
+        else:
+            self._slots.move_to_end(key)
+        return slot
+
+    def _evict(self) -> None:
+        while len(self._slots) > self.max_messages:
+            key, slot = next(iter(self._slots.items()))
+            if slot.task is not None and not slot.task.done():
+                break
+            del self._slots[key]
+
+    def seed(self, chat_id: int, message_id: int, markup: InlineKeyboardMarkup | None) -> None:
+        """Record the markup a message was sent with, so a no-op edit is skipped."""
+        self._slot(chat_id, message_id).sent_hash = markup_hash(markup)
+
+    def submit(
+        self, chat_id: int, message_id: int, markup: InlineKeyboardMarkup | None, edit: EditFn
+    ) -> None:
+        self.stats["submitted"] += 1
+        slot = self._slot(chat_id, message_id)
+        slot.markup = markup
+        slot.edit = edit
+        if slot.task is None or slot.task.done():
+            slot.task = asyncio.create_task(self._flush(chat_id, slot))
+
+    def blocked_for(self, chat_id: int) -> float:
+        return max(0.0, self._blocked_until.get(chat_id, 0.0) - time.monotonic())
+
+    async def _flush(self, chat_id: int, slot: _Slot) -> None:
+        await asyncio.sleep(self.delay)
+        while True:
+            wait = self.blocked_for(chat_id)
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            markup = slot.markup
+            h = markup_hash(markup)
+            if h == slot.sent_hash:
+                self.stats["skipped"] += 1
+                return
+            try:
+                with TELEGRAM_SECONDS.time("edit_reply_markup"):
+                    await slot.edit(markup)
+            except RetryAfter as e:
+                self.stats["retry_after"] += 1
+                self._blocked_until[chat_id] = time.monotonic() + float(e.retry_after)
+                continue
+            except BadRequest as e:
+                if "not modified" not in str(e).lower():
+                    self.stats["failed"] += 1
+                    print("Failed to edit keyboard", e)
+                    return
+            except TelegramError as e:
+                # TimedOut, NetworkError, Forbidden: give up on this markup,
+                # but still send one that arrived meanwhile
+                self.stats["failed"] += 1
+                print("Failed to edit keyboard", e)
+                if slot.markup is markup:
+                    return
+                await asyncio.sleep(self.delay)
+                continue
+            else:
+                self.stats["sent"] += 1
+            slot.sent_hash = h
+            if slot.markup is markup:
+                return
+            # more taps arrived while the edit was in flight
+            await asyncio.sleep(self.delay)
+
+    async def close(self) -> None:
+        tasks = [s.task for s in self._slots.values() if s.task is not None and not s.task.done()]
+        for t in tasks:
+            t.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
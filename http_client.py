@@ -0,0 +1,64 @@
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Dict, Tuple
+
+import aiohttp
+
+
+class HttpClient:
+    """Long-lived pooled aiohttp client for conditional and streamed GETs.
+
+    Callers keep the ETag and the parsed result themselves, so only a 304 or
+    the changed body crosses the network.
+
+    The underlying ``ClientSession`` is created lazily so that it binds to the
+    event loop the bot actually runs on.
+    """
+
+    def __init__(self, limit: int = 20, timeout: float = 15):
+        self.limit = limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout)
+        self._session: aiohttp.ClientSession | None = None
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(limit=self.limit, ttl_dns_cache=300)
+            self._session = aiohttp.ClientSession(connector=connector, timeout=self.timeout)
+        return self._session
+
+    async def get_if_changed(
+        self, url: str, headers: Dict[str, str] | None = None, etag: str | None = None
+    ) -> Tuple[bytes | None, str | None]:
+        """Conditional GET with a caller-held ETag.
+
+        Returns ``(None, etag)`` when the server answers 304.
+        """
+        req_headers = dict(headers or {})
+        if etag:
+            req_headers["If-None-Match"] = etag
+        async with self.session.get(url, headers=req_headers) as resp:
+            if resp.status == 304:
+                return None, etag
+            resp.raise_for_status()
+            return await resp.read(), resp.headers.get("ETag")
+
+    @asynccontextmanager
+    async def stream(
+        self, url: str, headers: Dict[str, str] | None = None, etag: str | None = None
+    ) -> AsyncIterator[aiohttp.ClientResponse]:
+        """Open a response for incremental reading.
+
+        The response has status 200, or 304 when ``etag`` still matches.
+        """
+        req_headers = dict(headers or {})
+        if etag:
+            req_headers["If-None-Match"] = etag
+        async with self.session.get(url, headers=req_headers) as resp:
+            if resp.status != 304:
+                resp.raise_for_status()
+            yield resp
+
+    async def close(self) -> None:
+        if self._session is not None and not self._session.closed:
+            await self._session.close()
+        self._session = None
@@ -0,0 +1,168 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterator, List, Sequence, Tuple
+
+# seconds, from 100 µs to 60 s
+LATENCY_BUCKETS = (
+    0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05,
+    0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60,
+)
+# bytes, from 1 KB to 64 MB
+SIZE_BUCKETS = tuple(1 << n for n in range(10, 27, 2))
+# nodes, from 10 to 100k
+COUNT_BUCKETS = (10, 50, 100, 500, 1000, 5000, 10000, 50000, 100000)
+
+Labels = Tuple[str, ...]
+
+
+def _labels(names: Sequence[str], values: Labels) -> str:
+    if not names:
+        return ""
+    pairs = ",".join(f'{n}="{v}"' for n, v in zip(names, values))
+    return "{" + pairs + "}"
+
+
+class Counter:
+    def __init__(self, name: str, help: str, labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.label_names = tuple(labels)
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, *labels: str, amount: float = 1) -> None:
+        self.values[labels] = self.values.get(labels, 0) + amount
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in sorted(self.values.items()):
+            yield f"{self.name}{_labels(self.label_names, labels)} {value:g}"
+
+
+class Gauge:
+    """A value read from ``fn`` at scrape time."""
+
+    def __init__(self, name: str, help: str, fn: Callable[[], float]):
+        self.name = name
+        self.help = help
+        self.fn = fn
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} gauge"
+        yield f"{self.name} {self.fn():g}"
+
+
+class Histogram:
+    """Fixed-bucket histogram; ``observe`` is a bisect and two additions."""
+
+    def __init__(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                 labels: Sequence[str] = ()):
+        self.name = name
+        self.help = help
+        self.buckets = tuple(buckets)
+        self.label_names = tuple(labels)
+        # per label set: [count per bucket ... , +Inf count], sum
+        self.series: Dict[Labels, Tuple[List[int], List[float]]] = {}
+
+    def observe(self, value: float, *labels: str) -> None:
+        series = self.series.get(labels)
+        if series is None:
+            series = self.series[labels] = ([0] * (len(self.buckets) + 1), [0.0])
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1][0] += value
+
+    @contextmanager
+    def time(self, *labels: str) -> Iterator[None]:
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *labels)
+
+    def quantile(self, q: float, *labels: str) -> float:
+        """Estimate from the buckets, interpolating inside the hit bucket."""
+        counts, _ = self.series.get(labels, ([0], [0.0]))
+        total = sum(counts)
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if count and seen + count >= rank:
+                lo = self.buckets[i - 1] if i else 0.0
+                hi = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lo + (hi - lo) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.help}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, (counts, total) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                le = _labels(self.label_names + ("le",), labels + (f"{bound:g}",))
+                yield f"{self.name}_bucket{le} {cumulative}"
+            cumulative += counts[-1]
+            yield f"{self.name}_bucket{_labels(self.label_names + ('le',), labels + ('+Inf',))} {cumulative}"
+            suffix = _labels(self.label_names, labels)
+            yield f"{self.name}_sum{suffix} {total[0]:g}"
+            yield f"{self.name}_count{suffix} {cumulative}"
+
+
+class Registry:
+    def __init__(self):
+        self.metrics: List[Counter | Gauge | Histogram] = []
+
+    def counter(self, name: str, help: str, labels: Sequence[str] = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, fn: Callable[[], float]) -> Gauge:
+        return self._add(Gauge(name, help, fn))
+
+    def histogram(self, name: str, help: str, buckets: Sequence[float] = LATENCY_BUCKETS,
+                  labels: Sequence[str] = ()) -> Histogram:
+        return self._add(Histogram(name, help, buckets, labels))
+
+    def _add(self, metric):
+        # re-registering a name replaces it, so a new BotApp can rebind gauges
+        self.metrics = [m for m in self.metrics if m.name != metric.name]
+        self.metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        """Prometheus text exposition format."""
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> List[str]:
+        """Short human-readable lines: histogram counts and p50/p99, counters."""
+        lines = []
+        for metric in self.metrics:
+            if isinstance(metric, Histogram):
+                scale, unit = (1000, "ms") if metric.buckets is LATENCY_BUCKETS else (1, "")
+                for labels, (counts, _) in sorted(metric.series.items()):
+                    name = metric.name + (f"[{','.join(labels)}]" if labels else "")
+                    p50 = metric.quantile(0.5, *labels) * scale
+                    p99 = metric.quantile(0.99, *labels) * scale
+                    lines.append(f"{name}: n={sum(counts)} p50={p50:.4g}{unit} p99={p99:.4g}{unit}")
+            elif isinstance(metric, Counter):
+                for labels, value in sorted(metric.values.items()):
+                    name = metric.name + (f"[{','.join(labels)}]" if labels else "")
+                    lines.append(f"{name}: {value:g}")
+            else:
+                lines.append(f"{metric.name}: {metric.fn():g}")
+        return lines
+
+
+REGISTRY = Registry()
+
+# shared by the keyboard edit coalescer and the bot's uploads
+TELEGRAM_SECONDS = REGISTRY.histogram(
+    "clashbot_telegram_seconds", "Telegram Bot API call latency", labels=("method",)
+)
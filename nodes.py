@@ -0,0 +1,168 @@
+import sys
+from array import array
+from dataclasses import dataclass, field
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+TLS = 1
+SKIP_CERT_VERIFY = 2
+UDP = 4
+
+# params that become typed columns in NodeStore; the rest go to the spill map
+KNOWN_PARAMS = frozenset(("transport", "flow", "sni", "over-tls", "skip-cert-verify", "udp"))
+
+
+@dataclass
+class NodeMeta:
+    name: str
+    host: str
+    port: int
+    uuid: str
+    params: Dict[str, str]
+    region: str
+
+
+def _intern(value: str | None) -> str | None:
+    return None if value is None else sys.intern(value)
+
+
+@dataclass(slots=True)
+class NodeStore:
+    """Column-oriented node list for large subscriptions.
+
+    Known params are kept as typed columns (booleans packed into one flag
+    byte per node), repeated strings such as hosts, SNIs and region codes
+    are interned, and only unusual params are kept per node in ``extra``.
+    """
+
+    names: List[str] = field(default_factory=list)
+    hosts: List[str] = field(default_factory=list)
+    ports: array = field(default_factory=lambda: array("I"))
+    uuids: List[str] = field(default_factory=list)
+    regions: List[str] = field(default_factory=list)
+    transports: List[str] = field(default_factory=list)
+    flows: List[str | None] = field(default_factory=list)
+    snis: List[str | None] = field(default_factory=list)
+    flags: bytearray = field(default_factory=bytearray)
+    extra: Dict[int, Dict[str, str]] = field(default_factory=dict)
+
+    @classmethod
+    def from_nodes(cls, nodes: Iterable[NodeMeta]) -> "NodeStore":
+        store = cls()
+        store.extend(nodes)
+        return store
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def append(self, node: NodeMeta) -> None:
+        p = node.params
+        flags = 0
+        if p.get("over-tls") == "true":
+            flags |= TLS
+        if p.get("skip-cert-verify", "true") != "false":
+            flags |= SKIP_CERT_VERIFY
+        if p.get("udp") == "true":
+            flags |= UDP
+        self.names.append(node.name)
+        self.hosts.append(sys.intern(node.host))
+        self.ports.append(node.port)
+        self.uuids.append(node.uuid)
+        self.regions.append(sys.intern(node.region))
+        self.transports.append(sys.intern(p.get("transport", "tcp")))
+        self.flows.append(_intern(p.get("flow")))
+        self.snis.append(_intern(p.get("sni")))
+        self.flags.append(flags)
+        spill = {sys.intern(k): v for k, v in p.items() if k not in KNOWN_PARAMS}
+        if spill:
+            self.extra[len(self.names) - 1] = spill
+
+    def extend(self, nodes: Iterable[NodeMeta]) -> None:
+        for n in nodes:
+            self.append(n)
+
+    def __getitem__(self, i: int) -> NodeMeta:
+        flags = self.flags[i]
+        params = {"transport": self.transports[i]}
+        if self.flows[i] is not None:
+            params["flow"] = self.flows[i]
+        if self.snis[i] is not None:
+            params["sni"] = self.snis[i]
+        params["over-tls"] = "true" if flags & TLS else "false"
+        params["skip-cert-verify"] = "true" if flags & SKIP_CERT_VERIFY else "false"
+        params["udp"] = "true" if flags & UDP else "false"
+        params.update(self.extra.get(i, {}))
+        return NodeMeta(self.names[i], self.hosts[i], self.ports[i], self.uuids[i], params, self.regions[i])
+
+    def __iter__(self) -> Iterator[NodeMeta]:
+        return (self[i] for i in range(len(self)))
+
+    def append_row(self, src: "NodeStore", i: int, name: str | None = None) -> None:
+        """Copy row ``i`` of ``src``, optionally under a different name."""
+        self.names.append(src.names[i] if name is None else name)
+        self.hosts.append(src.hosts[i])
+        self.ports.append(src.ports[i])
+        self.uuids.append(src.uuids[i])
+        self.regions.append(src.regions[i])
+        self.transports.append(src.transports[i])
+        self.flows.append(src.flows[i])
+        self.snis.append(src.snis[i])
+        self.flags.append(src.flags[i])
+        if i in src.extra:
+            self.extra[len(self.names) - 1] = src.extra[i]
+
+    def subset(self, indices: Iterable[int]) -> "NodeStore":
+        """A new store with the given rows, in the given order."""
+        out = NodeStore()
+        for i in indices:
+            out.append_row(self, i)
+        return out
+
+    def proxies(self) -> Iterator[Dict[str, Any]]:
+        """Clash ``proxies`` entries, built straight from the columns."""
+        for name, host, port, uuid, transport, flow, sni, flags in zip(
+            self.names, self.hosts, self.ports, self.uuids,
+            self.transports, self.flows, self.snis, self.flags,
+        ):
+            yield {
+                "name": name,
+                "type": "vless",
+                "server": host,
+                "port": port,
+                "uuid": uuid,
+                "network": transport,
+                "flow": flow,
+                "tls": bool(flags & TLS),
+                "skip-cert-verify": bool(flags & SKIP_CERT_VERIFY),
+                "sni": sni,
+                "udp": bool(flags & UDP),
+            }
+
+
+def merge_stores(stores: Iterable[NodeStore]) -> Tuple[NodeStore, int]:
+    """Concatenate stores, dropping repeated (host, port, uuid) endpoints.
+
+    The first occurrence of an endpoint wins. Names that are already taken
+    get a " #2", " #3", ... suffix in input order, so the result is the same
+    for the same inputs. Returns the merged store and the number of
+    duplicates dropped.
+    """
+    out = NodeStore()
+    seen = set()
+    taken = set()
+    duplicates = 0
+    for store in stores:
+        for i in range(len(store)):
+            key = (store.hosts[i], store.ports[i], store.uuids[i])
+            if key in seen:
+                duplicates += 1
+                continue
+            seen.add(key)
+            name = store.names[i]
+            if name in taken:
+                k = 2
+                while f"{name} #{k}" in taken:
+                    k += 1
+                name = f"{name} #{k}"
+            taken.add(name)
+            out.append_row(store, i, name)
+    return out, duplicates
@@ -0,0 +1,88 @@
+import asyncio
+import time
+from typing import Dict, Iterable, Tuple
+
+from nodes import NodeStore
+
+Endpoint = Tuple[str, int]
+
+
+class Prober:
+    """Concurrent TCP-connect prober with a per-endpoint result cache.
+
+    ``probe`` returns the connect latency in seconds for reachable
+    endpoints and ``None`` for unreachable ones. Endpoints still pending
+    when ``deadline`` expires are left out of the result (unknown) and are
+    not cached.
+    """
+
+    def __init__(self, concurrency: int = 100, timeout: float = 3.0, deadline: float = 10.0, ttl: float = 600):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.ttl = ttl
+        self._slots = asyncio.Semaphore(concurrency)
+        self._cache: Dict[Endpoint, Tuple[float | None, float]] = {}
+
+    async def _connect(self, endpoint: Endpoint) -> float | None:
+        async with self._slots:
+            t0 = time.monotonic()
+            try:
+                _, writer = await asyncio.wait_for(asyncio.open_connection(*endpoint), self.timeout)
+            except Exception:
+                # refused, timed out, unresolvable or an invalid endpoint
+                latency = None
+            else:
+                latency = time.monotonic() - t0
+                writer.close()
+            self._cache[endpoint] = (latency, time.monotonic() + self.ttl)
+            return latency
+
+    async def probe(self, endpoints: Iterable[Endpoint]) -> Dict[Endpoint, float | None]:
+        now = time.monotonic()
+        results: Dict[Endpoint, float | None] = {}
+        pending: Dict[asyncio.Task, Endpoint] = {}
+        for ep in dict.fromkeys(endpoints):
+            hit = self._cache.get(ep)
+            if hit is not None and hit[1] > now:
+                results[ep] = hit[0]
+            else:
+                pending[asyncio.create_task(self._connect(ep))] = ep
+        if pending:
+            done, not_done = await asyncio.wait(pending, timeout=self.deadline)
+            for task in not_done:
+                task.cancel()
+            for task in done:
+                results[pending[task]] = task.result()
+        return results
+
+    def prune(self) -> None:
+        now = time.monotonic()
+        for ep in [ep for ep, (_, expires) in self._cache.items() if expires <= now]:
+            del self._cache[ep]
+
+
+def rank_nodes(
+    store: NodeStore, results: Dict[Endpoint, float | None], drop: bool
+) -> Tuple[NodeStore, int, int]:
+    """Order nodes by measured latency; unknown next, unreachable last.
+
+    With ``drop`` the unreachable nodes are removed instead, unless that
+    would remove every node. Returns the new store and the reachable and
+    unreachable counts.
+    """
+    reachable = []
+    unknown = []
+    dead = []
+    for i in range(len(store)):
+        ep = (store.hosts[i], store.ports[i])
+        if ep not in results:
+            unknown.append(i)
+        elif results[ep] is None:
+            dead.append(i)
+        else:
+            reachable.append((results[ep], i))
+    reachable.sort()
+    order = [i for _, i in reachable] + unknown
+    if not drop or not order:
+        order += dead
+    return store.subset(order), len(reachable), len(dead)
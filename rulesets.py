@@ -0,0 +1,165 @@
+import asyncio
+import hashlib
+import os
+import time
+from dataclasses import dataclass
+from typing import Callable, Dict, Iterable, List, Sequence, Tuple
+
+from http_client import HttpClient
+from util import LRUCache, atomic_write
+
+DOMAIN_TYPES = ("DOMAIN", "DOMAIN-SUFFIX")
+
+
+@dataclass(slots=True)
+class RuleSet:
+    name: str
+    rules: List[str]
+    digest: str
+
+
+def parse_rule_payload(text: str) -> List[str]:
+    """Rule lines of a Clash rule-provider file (``payload:`` list)."""
+    rules = []
+    for line in text.splitlines():
+        line = line.strip()
+        if not line.startswith("-"):
+            continue
+        rule = line[1:].strip().strip("'\"")
+        if rule and not rule.startswith("#"):
+            rules.append(rule)
+    return rules
+
+
+def _covered(domain: str, suffixes: set) -> bool:
+    parts = domain.split(".")
+    return any(".".join(parts[i:]) in suffixes for i in range(len(parts)))
+
+
+def bundle_rules(rule_sets: Sequence[Tuple[str, List[str]]]) -> Dict[str, List[str]]:
+    """De-duplicate rules across rule sets, in the order they are matched.
+
+    Clash evaluates RULE-SET lines in order, so a rule already present in an
+    earlier set, or a domain already covered by an earlier DOMAIN-SUFFIX,
+    can never match in a later set and is dropped from it.
+    """
+    seen = set()
+    suffixes = set()
+    out: Dict[str, List[str]] = {}
+    for name, rules in rule_sets:
+        kept = []
+        for rule in rules:
+            if rule in seen:
+                continue
+            kind, _, rest = rule.partition(",")
+            if kind in DOMAIN_TYPES:
+                domain = rest.split(",", 1)[0].lower()
+                if _covered(domain, suffixes):
+                    continue
+                if kind == "DOMAIN-SUFFIX":
+                    suffixes.add(domain)
+            seen.add(rule)
+            kept.append(rule)
+        out[name] = kept
+    return out
+
+
+class RuleSetStore:
+    """Downloads rule-provider files and keeps them on disk.
+
+    A file younger than ``ttl`` is used as is; an older one is revalidated
+    with its stored ETag. Parsed sets are also held in a small in-memory
+    LRU. ``listeners`` are called in a worker thread with every set loaded
+    from the network or from disk.
+    """
+
+    def __init__(
+        self,
+        client: HttpClient,
+        url_for: Callable[[str], str],
+        directory: str = "rulesets",
+        concurrency: int = 8,
+        ttl: float = 86400,
+        max_entries: int = 64,
+    ):
+        self.client = client
+        self.url_for = url_for
+        self.directory = directory
+        self.ttl = ttl
+        self.listeners: List[Callable[[RuleSet], None]] = []
+        self._slots = asyncio.Semaphore(concurrency)
+        # name -> (rule set, load time)
+        self._entries = LRUCache(max_entries)
+
+    def _path(self, name: str, ext: str) -> str:
+        return os.path.join(self.directory, f"{name}.{ext}")
+
+    def _read(self, name: str) -> Tuple[bytes | None, str | None, float]:
+        try:
+            path = self._path(name, "yaml")
+            with open(path, "rb") as f:
+                body = f.read()
+            mtime = os.path.getmtime(path)
+        except OSError:
+            return None, None, 0.0
+        try:
+            with open(self._path(name, "etag"), "r", encoding="utf-8") as f:
+                etag = f.read().strip() or None
+        except OSError:
+            etag = None
+        return body, etag, mtime
+
+    def _write(self, name: str, body: bytes, etag: str | None) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        atomic_write(self._path(name, "yaml"), body)
+        atomic_write(self._path(name, "etag"), etag or "")
+
+    def _remember(self, rule_set: RuleSet, checked_at: float) -> RuleSet:
+        self._entries.put(rule_set.name, (rule_set, checked_at))
+        return rule_set
+
+    async def _load(self, name: str, body: bytes, checked_at: float) -> RuleSet:
+        rule_set = self._remember(await asyncio.to_thread(self._parse, name, body), checked_at)
+        for listener in self.listeners:
+            await asyncio.to_thread(listener, rule_set)
+        return rule_set
+
+    @staticmethod
+    def _parse(name: str, body: bytes) -> RuleSet:
+        return RuleSet(name, parse_rule_payload(body.decode("utf-8", errors="replace")),
+                       hashlib.sha256(body).hexdigest())
+
+    async def get(self, name: str) -> RuleSet:
+        hit = self._entries.get(name)
+        if hit is not None and time.time() - hit[1] < self.ttl:
+            return hit[0]
+        async with self._slots:
+            body, etag, mtime = await asyncio.to_thread(self._read, name)
+            if body is not None and time.time() - mtime < self.ttl:
+                return await self._load(name, body, mtime)
+            try:
+                fresh, etag = await self.client.get_if_changed(self.url_for(name), etag=etag)
+            except Exception:
+                if body is None:
+                    raise
+                # serve the stale copy, still stale, so the next call retries
+                return await self._load(name, body, mtime)
+            if fresh is None:
+                await asyncio.to_thread(os.utime, self._path(name, "yaml"))
+            else:
+                body = fresh
+                await asyncio.to_thread(self._write, name, body, etag)
+            return await self._load(name, body, time.time())
+
+    async def get_many(self, names: Iterable[str]) -> Tuple[Dict[str, RuleSet], Dict[str, str]]:
+        """Fetch concurrently; returns the loaded sets and errors by name."""
+        names = list(dict.fromkeys(names))
+        results = await asyncio.gather(*(self.get(n) for n in names), return_exceptions=True)
+        loaded: Dict[str, RuleSet] = {}
+        errors: Dict[str, str] = {}
+        for name, result in zip(names, results):
+            if isinstance(result, BaseException):
+                errors[name] = str(result) or type(result).__name__
+            else:
+                loaded[name] = result
+        return loaded, errors
@@ -0,0 +1,71 @@
+from bisect import bisect_left
+from typing import Dict, List, Sequence, Tuple
+
+from util import LRUCache
+
+NGRAM = 3
+
+
+class CategoryIndex:
+    """Search structures over the rule category names, built once per list.
+
+    Prefix queries bisect a sorted list of lowercased names; substring queries
+    intersect n-gram posting lists and verify the survivors. Results keep the
+    order of the original list and are cached per query, so paging through a
+    filter only slices an existing tuple.
+    """
+
+    def __init__(self, names: Sequence[str], cache_size: int = 256):
+        self.names: Tuple[str, ...] = tuple(names)
+        self.lowered: Tuple[str, ...] = tuple(n.lower() for n in self.names)
+        order = sorted(range(len(self.names)), key=lambda i: self.lowered[i])
+        self._sorted_keys: List[str] = [self.lowered[i] for i in order]
+        self._sorted_pos: List[int] = order
+        self._grams: Dict[str, List[int]] = {}
+        for i, low in enumerate(self.lowered):
+            seen = set()
+            for n in range(1, NGRAM + 1):
+                for j in range(len(low) - n + 1):
+                    g = low[j:j + n]
+                    if g not in seen:
+                        seen.add(g)
+                        self._grams.setdefault(g, []).append(i)
+        self._cache = LRUCache(cache_size)
+
+    def __len__(self) -> int:
+        return len(self.names)
+
+    def search(self, query: str | None, prefix: bool = False) -> Tuple[str, ...]:
+        if not query:
+            return self.names
+        q = query.lower()
+        key = (prefix, q)
+        hit = self._cache.get(key)
+        if hit is not None:
+            return hit
+        positions = self._prefix(q) if prefix else self._substring(q)
+        result = tuple(self.names[i] for i in positions)
+        self._cache.put(key, result)
+        return result
+
+    def _prefix(self, q: str) -> List[int]:
+        lo = bisect_left(self._sorted_keys, q)
+        hi = bisect_left(self._sorted_keys, q + "\U0010ffff", lo)
+        return sorted(self._sorted_pos[lo:hi])
+
+    def _substring(self, q: str) -> List[int]:
+        if len(q) <= NGRAM:
+            return self._grams.get(q, [])
+        postings = []
+        for j in range(len(q) - NGRAM + 1):
+            p = self._grams.get(q[j:j + NGRAM])
+            if not p:
+                return []
+            postings.append(p)
+        postings.sort(key=len)
+        candidates = set(postings[0])
+        for p in postings[1:]:
+            candidates.intersection_update(p)
+            if not candidates:
+                return []
+        return sorted(i for i in candidates if q in self.lowered[i])
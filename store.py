@@ -0,0 +1,495 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+import time
+import zlib
+from typing import Any, Dict, Iterable, List, Sequence
+from urllib.parse import unquote, urlsplit
+
+from util import atomic_write
+
+COMPRESS_THRESHOLD = 256
+KEY_PREFIX = "clashbot"
+
+
+def pack(value: Any) -> bytes:
+    """Compact bytes for a JSON-able value; zlib-compressed when large."""
+    data = json.dumps(value, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+    if len(data) > COMPRESS_THRESHOLD:
+        return b"z" + zlib.compress(data)
+    return b"j" + data
+
+
+def unpack(data: bytes) -> Any:
+    body = zlib.decompress(data[1:]) if data[:1] == b"z" else data[1:]
+    return json.loads(body)
+
+
+class GroupFile:
+    """``groups.json`` with a write-ahead journal.
+
+    Every change is appended to ``<path>.journal`` and fsynced before the
+    command is acknowledged; the JSON file itself is rewritten later, in one
+    batch, through a temp file, fsync and rename, after which the journal is
+    cleared. Loading replays the journal over the file, so a crash at any
+    point loses nothing. All methods block and are meant for worker threads.
+    """
+
+    def __init__(self, path: str = "groups.json"):
+        self.path = path
+        self.journal = path + ".journal"
+        self.groups: Dict[str, List[str]] = {}
+        self.dirty = False
+        self._stat: tuple | None = None
+        # an outside edit was merged in by flush() and not load()ed yet
+        self._merged = False
+        self._lock = threading.Lock()
+
+    def _file_stat(self) -> tuple | None:
+        try:
+            st = os.stat(self.path)
+        except OSError:
+            return None
+        return (st.st_ino, st.st_size, st.st_mtime_ns)
+
+    def load(self) -> Dict[str, List[str]]:
+        """Read the file and replay the journal; ValueError if the file is
+        not valid JSON (it is then left alone)."""
+        with self._lock:
+            self._read()
+            self._merged = False
+            return {k: list(v) for k, v in self.groups.items()}
+
+    def _read(self) -> None:
+        """``load`` without the lock: file plus journal into ``groups``."""
+        stat = self._file_stat()
+        groups: Dict[str, List[str]] = {}
+        if stat is not None:
+            with open(self.path, "r", encoding="utf-8") as f:
+                try:
+                    obj = json.load(f)
+                except ValueError as e:
+                    # remember the stat so the same broken file is not retried
+                    self._stat = stat
+                    raise ValueError(f"{self.path}: {e}") from e
+            if isinstance(obj, dict):
+                groups = {k: [str(x) for x in v] for k, v in obj.items() if isinstance(v, list)}
+        replayed = 0
+        try:
+            with open(self.journal, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        name, rules = json.loads(line)
+                    except ValueError:
+                        continue  # torn last line
+                    if rules is None:
+                        groups.pop(name, None)
+                    else:
+                        groups[name] = [str(x) for x in rules]
+                    replayed += 1
+        except OSError:
+            pass
+        self.groups = groups
+        self.dirty = bool(replayed)
+        self._stat = stat
+
+    def append(self, groups: Dict[str, List[str]], changed: Iterable[str]) -> None:
+        """Journal the named groups' new state (None when deleted)."""
+        with self._lock:
+            lines = []
+            for name in changed:
+                rules = groups.get(name)
+                rules = None if rules is None else list(rules)
+                lines.append(json.dumps([name, rules], ensure_ascii=False) + "\n")
+                if rules is None:
+                    self.groups.pop(name, None)
+                else:
+                    self.groups[name] = rules
+            # keep the caller's order of groups; ones it has not seen yet
+            # (merged from an outside edit) go last
+            ordered = {k: self.groups[k] for k in groups if k in self.groups}
+            self.groups = {**ordered, **{k: v for k, v in self.groups.items() if k not in ordered}}
+            with open(self.journal, "a", encoding="utf-8") as f:
+                f.writelines(lines)
+                f.flush()
+                os.fsync(f.fileno())
+            self.dirty = True
+
+    def flush(self) -> None:
+        """Write out the journaled changes. If the file was edited by
+        someone else since it was read, the journal is replayed over the
+        edited file instead, and ``changed()`` stays true until the merged
+        groups are ``load()``ed. ValueError if that edit is not valid JSON;
+        the journal is then kept."""
+        with self._lock:
+            if not self.dirty:
+                return
+            if self._file_stat() != self._stat:
+                self._read()
+                self._merged = True
+            atomic_write(self.path, json.dumps(self.groups, ensure_ascii=False, indent=2), durable=True)
+            try:
+                os.remove(self.journal)
+            except OSError:
+                pass
+            self._stat = self._file_stat()
+            self.dirty = False
+
+    def changed(self) -> bool:
+        """Whether the file was replaced or edited by someone else."""
+        return self._merged or self._file_stat() != self._stat
+
+
+class SessionStore:
+    """Where per-user session state and the rule groups are kept.
+
+    This base store keeps sessions only in the worker's own memory
+    (``shared`` is False, so the bot never round-trips them) and groups in a
+    journaled JSON file that is rewritten ``flush_delay`` seconds after the
+    first unsaved change. Shared backends keep one packed blob per user,
+    expiring after the given TTL, on the shard picked by user id; groups
+    live on shard 0, one entry per group so workers saving different groups
+    do not overwrite each other. A shared store that has never held groups
+    is seeded once from the JSON file, which is not read after that.
+    """
+
+    shared = False
+
+    def __init__(self, shards: int = 1, groups_path: str = "groups.json", flush_delay: float = 2.0):
+        self.shards = shards
+        self.group_file = GroupFile(groups_path)
+        self.flush_delay = flush_delay
+        self._flush_task: asyncio.Task | None = None
+
+    def shard(self, uid: int) -> int:
+        return uid % self.shards
+
+    async def get(self, uid: int) -> bytes | None:
+        return None
+
+    async def put(self, uid: int, data: bytes, ttl: int) -> None:
+        pass
+
+    async def delete(self, uid: int) -> None:
+        pass
+
+    async def load_groups(self) -> Dict[str, List[str]]:
+        return await asyncio.to_thread(self.group_file.load)
+
+    async def save_groups(self, groups: Dict[str, List[str]], changed: Iterable[str]) -> None:
+        """Persist ``groups`` after the named groups were changed or removed."""
+        snapshot = {k: list(v) for k, v in groups.items()}
+        await asyncio.to_thread(self.group_file.append, snapshot, list(changed))
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self.flush_delay)
+        try:
+            await asyncio.to_thread(self.group_file.flush)
+        except (OSError, ValueError) as e:
+            # the journal still has the changes; the next save retries
+            print(f"Failed to write {self.group_file.path}: {e}")
+
+    async def groups_changed(self) -> bool:
+        """Whether groups may have been changed outside this worker."""
+        return await asyncio.to_thread(self.group_file.changed)
+
+    async def purge(self) -> None:
+        """Drop expired sessions, for backends without native expiry."""
+
+    async def seed_groups(self) -> Dict[str, List[str]]:
+        """Groups from the JSON file, for seeding a shared store."""
+        try:
+            return await asyncio.to_thread(self.group_file.load)
+        except ValueError as e:
+            print(f"Not seeding groups from {self.group_file.path}: {e}")
+            return {}
+
+    async def close(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+        try:
+            await asyncio.to_thread(self.group_file.flush)
+        except (OSError, ValueError) as e:
+            print(f"Failed to write {self.group_file.path}: {e}")
+
+
+class SQLiteStore(SessionStore):
+    """One SQLite database file per shard, accessed from worker threads."""
+
+    shared = True
+
+    def __init__(self, paths: Sequence[str], groups_path: str = "groups.json"):
+        super().__init__(len(paths), groups_path)
+        self._conns = []
+        self._locks = [threading.Lock() for _ in paths]
+        for path in paths:
+            conn = sqlite3.connect(path, check_same_thread=False, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS sessions"
+                " (uid INTEGER PRIMARY KEY, data BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            conn.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, data BLOB NOT NULL)")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS groups"
+                " (name TEXT PRIMARY KEY, pos INTEGER NOT NULL, rules BLOB NOT NULL)"
+            )
+            self._conns.append(conn)
+
+    async def _run(self, shard: int, sql: str, args: tuple = ()) -> list:
+        def run():
+            with self._locks[shard]:
+                return self._conns[shard].execute(sql, args).fetchall()
+
+        return await asyncio.to_thread(run)
+
+    async def _transaction(self, shard: int, statements: Sequence[tuple]) -> None:
+        def run():
+            with self._locks[shard]:
+                conn = self._conns[shard]
+                conn.execute("BEGIN IMMEDIATE")
+                try:
+                    for sql, args in statements:
+                        conn.execute(sql, args)
+                except BaseException:
+                    conn.execute("ROLLBACK")
+                    raise
+                conn.execute("COMMIT")
+
+        await asyncio.to_thread(run)
+
+    @staticmethod
+    def _group_statements(groups: Dict[str, List[str]], names: Iterable[str]) -> List[tuple]:
+        statements = []
+        for name in names:
+            if name in groups:
+                # a new group goes last; an existing one keeps its place
+                statements.append((
+                    "INSERT INTO groups (name, pos, rules)"
+                    " VALUES (?, (SELECT COALESCE(MAX(pos), 0) + 1 FROM groups), ?)"
+                    " ON CONFLICT(name) DO UPDATE SET rules = excluded.rules",
+                    (name, pack(groups[name])),
+                ))
+            else:
+                statements.append(("DELETE FROM groups WHERE name = ?", (name,)))
+        return statements
+
+    async def get(self, uid: int) -> bytes | None:
+        rows = await self._run(
+            self.shard(uid), "SELECT data FROM sessions WHERE uid = ? AND expires > ?", (uid, time.time())
+        )
+        return rows[0][0] if rows else None
+
+    async def put(self, uid: int, data: bytes, ttl: int) -> None:
+        await self._run(
+            self.shard(uid),
+            "INSERT OR REPLACE INTO sessions (uid, data, expires) VALUES (?, ?, ?)",
+            (uid, data, time.time() + ttl),
+        )
+
+    async def delete(self, uid: int) -> None:
+        await self._run(self.shard(uid), "DELETE FROM sessions WHERE uid = ?", (uid,))
+
+    async def load_groups(self) -> Dict[str, List[str]]:
+        if not await self._run(0, "SELECT 1 FROM meta WHERE key = 'groups_seeded'"):
+            seed = await self.seed_groups()
+            await self._transaction(0, [
+                *self._group_statements(seed, seed),
+                ("INSERT OR IGNORE INTO meta (key, data) VALUES ('groups_seeded', x'')", ()),
+            ])
+        rows = await self._run(0, "SELECT name, rules FROM groups ORDER BY pos")
+        return {name: unpack(rules) for name, rules in rows}
+
+    async def groups_changed(self) -> bool:
+        return True
+
+    async def save_groups(self, groups: Dict[str, List[str]], changed: Iterable[str] = ()) -> None:
+        await self._transaction(0, self._group_statements(groups, changed))
+
+    async def purge(self) -> None:
+        for shard in range(self.shards):
+            await self._run(shard, "DELETE FROM sessions WHERE expires <= ?", (time.time(),))
+
+    async def close(self) -> None:
+        for lock, conn in zip(self._locks, self._conns):
+            with lock:
+                conn.close()
+        self._conns = []
+
+
+class RedisError(Exception):
+    pass
+
+
+class RedisClient:
+    """Minimal RESP2 client with a small connection pool.
+
+    Works with Redis and protocol-compatible servers (Valkey, KeyDB,
+    Dragonfly). The URL form is ``redis://[:password@]host[:port][/db]``.
+    """
+
+    def __init__(self, url: str, pool_size: int = 4):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.strip("/") or 0)
+        self._pool: asyncio.Queue | None = None
+        self._pool_size = pool_size
+
+    async def _connect(self) -> tuple:
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        conn = (reader, writer)
+        if self.password:
+            await self._call(conn, ("AUTH", self.password))
+        if self.db:
+            await self._call(conn, ("SELECT", self.db))
+        return conn
+
+    @staticmethod
+    def _encode(args: Sequence[Any]) -> bytes:
+        out = [b"*%d\r\n" % len(args)]
+        for arg in args:
+            if not isinstance(arg, bytes):
+                arg = str(arg).encode("utf-8")
+            out.append(b"$%d\r\n%s\r\n" % (len(arg), arg))
+        return b"".join(out)
+
+    @classmethod
+    async def _read(cls, reader: asyncio.StreamReader) -> Any:
+        line = await reader.readline()
+        if not line:
+            raise ConnectionError("connection closed")
+        kind, rest = line[:1], line[1:-2]
+        if kind == b"+":
+            return rest.decode()
+        if kind == b"-":
+            raise RedisError(rest.decode())
+        if kind == b":":
+            return int(rest)
+        if kind == b"$":
+            n = int(rest)
+            return None if n < 0 else (await reader.readexactly(n + 2))[:-2]
+        if kind == b"*":
+            n = int(rest)
+            return None if n < 0 else [await cls._read(reader) for _ in range(n)]
+        raise ConnectionError(f"unexpected reply {line!r}")
+
+    async def _call(self, conn: tuple, args: Sequence[Any]) -> Any:
+        reader, writer = conn
+        writer.write(self._encode(args))
+        await writer.drain()
+        return await self._read(reader)
+
+    async def execute(self, *args: Any) -> Any:
+        if self._pool is None:
+            self._pool = asyncio.Queue()
+            for _ in range(self._pool_size):
+                self._pool.put_nowait(None)
+        conn = await self._pool.get()
+        try:
+            if conn is None:
+                conn = await self._connect()
+            result = await self._call(conn, args)
+        except RedisError:
+            # an error reply is read in full, so the connection stays in sync
+            raise
+        except BaseException:
+            # anything else, cancellation included, may leave a reply half read
+            if conn is not None:
+                conn[1].close()
+            conn = None
+            raise
+        finally:
+            self._pool.put_nowait(conn)
+        return result
+
+    async def close(self) -> None:
+        if self._pool is None:
+            return
+        while not self._pool.empty():
+            conn = self._pool.get_nowait()
+            if conn is not None:
+                conn[1].close()
+        self._pool = None
+
+
+class RedisStore(SessionStore):
+    """One Redis-protocol server per shard; keys expire natively."""
+
+    shared = True
+
+    GROUPS = f"{KEY_PREFIX}:groups:rules"
+    GROUP_ORDER = f"{KEY_PREFIX}:groups:order"
+    GROUP_SEQ = f"{KEY_PREFIX}:groups:seq"
+    GROUPS_SEEDED = f"{KEY_PREFIX}:groups:seeded"
+
+    def __init__(self, urls: Sequence[str], groups_path: str = "groups.json"):
+        super().__init__(len(urls), groups_path)
+        self._clients = [RedisClient(url) for url in urls]
+
+    def _key(self, uid: int) -> str:
+        # the hash tag keeps a shard's keys in one slot on a Redis Cluster
+        return f"{KEY_PREFIX}:{{{self.shard(uid)}}}:session:{uid}"
+
+    async def get(self, uid: int) -> bytes | None:
+        return await self._clients[self.shard(uid)].execute("GET", self._key(uid))
+
+    async def put(self, uid: int, data: bytes, ttl: int) -> None:
+        await self._clients[self.shard(uid)].execute("SET", self._key(uid), data, "EX", ttl)
+
+    async def delete(self, uid: int) -> None:
+        await self._clients[self.shard(uid)].execute("DEL", self._key(uid))
+
+    async def load_groups(self) -> Dict[str, List[str]]:
+        redis = self._clients[0]
+        if await redis.execute("SET", self.GROUPS_SEEDED, 1, "NX"):
+            seed = await self.seed_groups()
+            await self.save_groups(seed, seed)
+        fields = await redis.execute("HGETALL", self.GROUPS) or []
+        rules = {fields[i].decode("utf-8"): unpack(fields[i + 1]) for i in range(0, len(fields), 2)}
+        order = [name.decode("utf-8") for name in await redis.execute("ZRANGE", self.GROUP_ORDER, 0, -1) or []]
+        # names missing from the order (a save cut short) go last
+        return {name: rules[name] for name in dict.fromkeys(order + list(rules)) if name in rules}
+
+    async def groups_changed(self) -> bool:
+        return True
+
+    async def save_groups(self, groups: Dict[str, List[str]], changed: Iterable[str] = ()) -> None:
+        redis = self._clients[0]
+        for name in changed:
+            if name in groups:
+                await redis.execute("HSET", self.GROUPS, name, pack(groups[name]))
+                # NX: an existing group keeps its place
+                await redis.execute("ZADD", self.GROUP_ORDER, "NX", await redis.execute("INCR", self.GROUP_SEQ), name)
+            else:
+                await redis.execute("HDEL", self.GROUPS, name)
+                await redis.execute("ZREM", self.GROUP_ORDER, name)
+
+    async def close(self) -> None:
+        for client in self._clients:
+            await client.close()
+
+
+def open_store(spec: str, groups_path: str = "groups.json", flush_delay: float = 2.0) -> SessionStore:
+    """Store for ``spec``: ``memory``, or comma-separated ``sqlite:///path``
+    or ``redis://host`` locations, one per shard."""
+    spec = (spec or "memory").strip()
+    if spec == "memory":
+        return SessionStore(groups_path=groups_path, flush_delay=flush_delay)
+    locations = [s.strip() for s in spec.split(",") if s.strip()]
+    schemes = {urlsplit(s).scheme for s in locations}
+    if schemes == {"sqlite"}:
+        paths = [s[len("sqlite:///"):] if s.startswith("sqlite:///") else s[len("sqlite://"):] for s in locations]
+        for path in paths:
+            if os.path.dirname(path):
+                os.makedirs(os.path.dirname(path), exist_ok=True)
+        return SQLiteStore(paths, groups_path)
+    if schemes == {"redis"}:
+        return RedisStore(locations, groups_path)
+    raise ValueError(f"unsupported SESSION_STORE: {spec}")
@@ -0,0 +1,116 @@
+import json
+import secrets
+import time
+from dataclasses import asdict, dataclass, field
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Dict, List, Mapping, Sequence
+
+from util import atomic_write
+
+
+@dataclass(slots=True)
+class Subscription:
+    token: str
+    uid: int
+    gists: List[str]
+    apps: List[str]
+    created: float = field(default_factory=time.time)
+
+
+@dataclass(slots=True)
+class ServedConfig:
+    """What a subscription URL last served, and the source digest it came from."""
+
+    digest: str
+    key: str
+    data: bytes
+    last_modified: float = field(default_factory=time.time)
+
+    @property
+    def etag(self) -> str:
+        return f'"{self.key[:32]}"'
+
+    @property
+    def http_date(self) -> str:
+        return formatdate(self.last_modified, usegmt=True)
+
+
+class SubscriptionBook:
+    """Subscription tokens by value, kept in a JSON file.
+
+    The same user asking again for the same sources and rules gets the same
+    token, so a client that already has the URL keeps working.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        self.subs: Dict[str, Subscription] = {}
+
+    def __len__(self) -> int:
+        return len(self.subs)
+
+    @classmethod
+    def load(cls, path: str) -> "SubscriptionBook":
+        book = cls(path)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                for item in json.load(f):
+                    sub = Subscription(**item)
+                    book.subs[sub.token] = sub
+        except FileNotFoundError:
+            pass
+        except (ValueError, TypeError) as e:
+            print(f"Failed to load {path}: {e}")
+        return book
+
+    def snapshot(self) -> List[dict]:
+        return [asdict(s) for s in self.subs.values()]
+
+    def save(self, items: List[dict] | None = None) -> None:
+        """Write ``items`` (a ``snapshot()``, taken on the event loop when
+        saving from a thread) or the current subscriptions."""
+        atomic_write(self.path, json.dumps(self.snapshot() if items is None else items, ensure_ascii=False))
+
+    def get(self, token: str) -> Subscription | None:
+        return self.subs.get(token)
+
+    def issue(self, uid: int, gists: Sequence[str], apps: Sequence[str]) -> Subscription:
+        gists, apps = list(gists), sorted(apps)
+        for sub in self.subs.values():
+            if sub.uid == uid and sub.gists == gists and sub.apps == apps:
+                return sub
+        sub = Subscription(secrets.token_urlsafe(16), uid, gists, apps)
+        self.subs[sub.token] = sub
+        return sub
+
+    def revoke(self, uid: int) -> List[str]:
+        """Drop all of a user's subscriptions; returns their tokens."""
+        tokens = [t for t, s in self.subs.items() if s.uid == uid]
+        for token in tokens:
+            del self.subs[token]
+        return tokens
+
+
+def not_modified(headers: Mapping[str, str], served: ServedConfig) -> bool:
+    """Whether a conditional GET can be answered with 304.
+
+    ``If-None-Match`` wins over ``If-Modified-Since`` when both are sent.
+    """
+    tags = headers.get("If-None-Match")
+    if tags is not None:
+        return tags.strip() == "*" or served.etag in (t.strip().removeprefix("W/") for t in tags.split(","))
+    since = headers.get("If-Modified-Since")
+    if since is None:
+        return False
+    try:
+        return int(served.last_modified) <= parsedate_to_datetime(since).timestamp()
+    except (TypeError, ValueError):
+        return False
+
+
+def accepts_gzip(headers: Mapping[str, str]) -> bool:
+    for part in headers.get("Accept-Encoding", "").split(","):
+        coding, _, params = part.strip().partition(";")
+        if coding.strip().lower() in ("gzip", "*"):
+            return params.replace(" ", "") not in ("q=0", "q=0.0", "q=0.00", "q=0.000")
+    return False
@@ -0,0 +1,52 @@
+import pytest
+import yaml
+
+import clash_yaml
+from bot import GroupLayout, NodeMeta, build_config, parse_nodes
+from clash_yaml import dump_config, emit_clash_yaml
+
+TRICKY = [
+    "yes", "on", "Off", "null", "NULL", "true", "~", "",
+    "1", "0x1F", "1e3", "1.5", "007", "12:30", "2024-01-01", "-", "-a", ".5",
+    "a: b", "a #b", "#x", "trailing:", "a\nb", "tab\there", 'quo"te', "back\\slash",
+    "香港 01", "日本-IPLC 🇯🇵", "[x]", "{y}", "*ref", "&anchor", "!tag", "@at", "`tick", "%p", "|", ">",
+    " lead", "trail ", "x,y", "?", " ",
+]
+
+
+def nodes() -> list:
+    return [
+        NodeMeta(name, f"h{i}.example.net", 1000 + i, f"uuid-{i}",
+                 {"transport": "ws", "over-tls": "true", "sni": name or "x", "flow": "xtls-rprx-vision"},
+                 region)
+        for i, (name, region) in enumerate(
+            [("HK-01", "HK"), ("日本 东京 01", "JP"), ("yes", "US"), ("1.5", "SG"), ("a: b #c", "XX")]
+        )
+    ]
+
+
+EMITTERS = ["streaming"] + (["libyaml"] if clash_yaml._CSafeDumper is not None else [])
+
+
+@pytest.mark.parametrize("emitter", EMITTERS)
+@pytest.mark.parametrize("layout", [GroupLayout(), GroupLayout(topology="regional")])
+def test_dump_config_round_trips(emitter, layout):
+    config = build_config(nodes(), ["Netflix", "YouTube", "Telegram"], layout,
+                          {"Netflix": ["DOMAIN-SUFFIX,netflix.com", "DOMAIN,a: b"]})
+    assert yaml.safe_load(dump_config(config, emitter)) == config
+
+
+def test_parsed_nodes_round_trip():
+    store = parse_nodes(
+        'HK-01=vless,1478523.xyz,12101,"xxx",transport=tcp,over-tls=true,skip-cert-verify=false,'
+        'flow=xtls-rprx-vision,sni=www.msi.com,public-key="xxx",short-id=xxx,udp=true\n'
+        "香港 02=vless,h.example,443,uuid,over-tls=true"
+    )
+    config = build_config(store, ["Netflix"])
+    assert yaml.safe_load(emit_clash_yaml(config)) == config
+
+
+@pytest.mark.parametrize("value", TRICKY)
+def test_scalar_quoting(value):
+    config = {"name": value, "items": [{value: [value, 1, True, None]}], "map": {value: {"k": value}}}
+    assert yaml.safe_load(emit_clash_yaml(config)) == config
@@ -0,0 +1,52 @@
+import asyncio
+import socket
+
+from nodes import NodeMeta, NodeStore
+from probe import Prober, rank_nodes
+
+
+def closed_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+
+def store(*endpoints) -> NodeStore:
+    return NodeStore.from_nodes(
+        NodeMeta(f"N{i}", host, port, "uuid", {}, "N") for i, (host, port) in enumerate(endpoints)
+    )
+
+
+def test_probe_local_listener_and_closed_port():
+    async def run():
+        server = await asyncio.start_server(lambda r, w: w.close(), "127.0.0.1", 0)
+        port = server.sockets[0].getsockname()[1]
+        dead = closed_port()
+        async with server:
+            return port, dead, await Prober(timeout=1, deadline=2).probe(
+                [("127.0.0.1", port), ("127.0.0.1", dead), ("127.0.0.1", 70000)]
+            )
+
+    port, dead, results = asyncio.run(run())
+    assert results[("127.0.0.1", port)] is not None
+    assert results[("127.0.0.1", dead)] is None
+    assert results[("127.0.0.1", 70000)] is None
+
+
+def test_rank_nodes_orders_by_latency_and_drops_or_demotes():
+    nodes = store(("dead", 1), ("slow", 2), ("unknown", 3), ("fast", 4))
+    results = {("dead", 1): None, ("slow", 2): 0.2, ("fast", 4): 0.01}
+
+    ranked, alive, dead = rank_nodes(nodes, results, drop=False)
+    assert list(ranked.hosts) == ["fast", "slow", "unknown", "dead"]
+    assert (alive, dead) == (2, 1)
+
+    ranked, _, _ = rank_nodes(nodes, results, drop=True)
+    assert list(ranked.hosts) == ["fast", "slow", "unknown"]
+
+
+def test_rank_nodes_keeps_everything_when_all_are_unreachable():
+    nodes = store(("a", 1), ("b", 2))
+    ranked, alive, dead = rank_nodes(nodes, {("a", 1): None, ("b", 2): None}, drop=True)
+    assert list(ranked.hosts) == ["a", "b"]
+    assert (alive, dead) == (0, 2)